@@ -1,25 +1,104 @@
 import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
 
 from nsds_lab_to_nwb.tools.htk.htk_reader import HTKReader
 from nsds_lab_to_nwb.tools.htk.readers.htkfile import HTKFile
-from nsds_lab_to_nwb.tools.tdt.tdt_reader import TDTReader
+from nsds_lab_to_nwb.tools.tdt.block_check import check_block
+from nsds_lab_to_nwb.tools.stream_iterator import DEFAULT_BUFFER_SIZE, StreamIterator
+from nsds_lab_to_nwb.tools.tdt.tdt_reader import TDTReader, probe_block
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 
 
 class RecManager():
-    def __init__(self, dataset):
+    def __init__(self, dataset, metadata=None, memmap_sev=False, buffer_size=DEFAULT_BUFFER_SIZE,
+                 drop_bad_chs=False, num_workers=None, cache_dir=None):
         self.dataset = dataset
+        self.metadata = metadata
+        self.buffer_size = buffer_size
+        self.num_workers = num_workers
+        self.futures = None
 
         if hasattr(self.dataset, 'htk_mark_path'):
             logger.info('Using HTK')
             self.rec_source = 'htk'
-            self.rec_reader = HTKReader(self.dataset.htk_path)
+            self.rec_reader = HTKReader(self.dataset.htk_path, cache_dir=cache_dir)
         else:
             logger.info('Using TDT')
             self.rec_source = 'tdt'
-            self.rec_reader = TDTReader(self.dataset.tdt_path)
+            self.rec_reader = TDTReader(self.dataset.tdt_path,
+                                        stores=self.get_required_stores(),
+                                        memmap_sev=memmap_sev,
+                                        drop_bad_chs=drop_bad_chs,
+                                        cache_dir=cache_dir)
+
+    def get_required_stores(self):
+        '''List the TDT stores needed for conversion, or None to read everything.
+        '''
+        if self.metadata is None:
+            return None
+
+        # one stream per device, plus the recorded mark track
+        stores = [device_name for device_name, dev_conf in self.metadata['device'].items()
+                  if not isinstance(dev_conf, str)]
+        stores.append('mrk1')
+        return stores
+
+    def get_channels(self, stream, dev_conf):
+        '''List the ids of the channels that read_neural_data() returns for a stream, in order
+        (the channels of the ch_map that are in the store, without the bad_chs if they are dropped).
+        Returns None if the channels are not known before reading (HTK, or a stream not in the block).
+        '''
+        if self.rec_source == 'htk':
+            return None
+        try:
+            stream = self.rec_reader.check_stream(stream)
+        except ValueError:
+            return None
+        return self.rec_reader.get_channels(stream, dev_conf)
+
+    def decode_stores(self):
+        '''Start decoding all the required TDT stores concurrently, in a thread pool
+        of num_workers threads (one per store if None), so that their reads overlap.
+        Returns a dict of {store name: future}; read_neural_data() and read_marks()
+        wait for the future of their store, and re-raise any error from decoding it.
+        Called on the first stream read, so that the headers and mark epocs can be
+        checked (see read_mark_events()) before any stream data is read.
+        '''
+        stores = self.get_required_stores()
+        executor = ThreadPoolExecutor(max_workers=self.num_workers or len(stores))
+        futures = {}
+        for store in stores:
+            dev_conf = self.metadata['device'].get(store)
+            futures[store] = executor.submit(self.rec_reader.decode, store, dev_conf)
+        # worker threads exit once the submitted stores are decoded
+        executor.shutdown(wait=False)
+        return futures
+
+    def _wait_for(self, stream):
+        if self.futures is None:
+            # first stream read; decode all the other stores alongside it
+            self.futures = {}
+            if self.rec_source == 'tdt' and self.metadata is not None and self.num_workers != 1:
+                self.futures = self.decode_stores()
+        future = self.futures.pop(stream, None)
+        if future is not None:
+            future.result()
+
+    def check_block(self):
+        '''Check the TDT block for missing stores and truncated files, from the TSQ index
+        and file sizes alone (see block_check.check_block()). Returns the report, or None for HTK.
+        '''
+        if self.rec_source == 'htk':
+            return None
+
+        header = self.rec_reader.header
+        sev_files = self.rec_reader.sev_files if self.rec_reader.sev_files else None
+        return check_block(self.dataset.tdt_path, stores=self.get_required_stores(),
+                           header=header, sev_files=sev_files)
 
     def read_info(self):
         if self.rec_source == 'htk':
@@ -27,22 +106,53 @@ class RecManager():
 
         return self.rec_reader.tdt_obj['info']
 
+    def probe(self):
+        '''Summarize the recording from the TDT headers, without reading any sample data.
+        Returns the start time, and the sample rate, channels and sample counts of each stream.
+        '''
+        if self.rec_source == 'htk':
+            return None
+
+        if self.rec_reader.header is not None:
+            # already parsed by a store-selective reader
+            return self.rec_reader.probe_info
+        return probe_block(self.dataset.tdt_path)
+
     def read_neural_data(self, stream, dev_conf):
+        self._wait_for(stream)
         data, metadata = self.rec_reader.get_data(stream=stream, dev_conf=dev_conf)
+        if self.rec_source == 'tdt':
+            # hand TDT streams over in contiguous, time-major blocks of buffer_size samples,
+            # instead of letting h5py copy the whole transposed (time, channel) view at once
+            if isinstance(data, np.ndarray):
+                data = StreamIterator(data, buffer_size=self.buffer_size)
+            else:
+                data.buffer_size = self.buffer_size
         return data, metadata
 
     def read_marks(self):
         # Read the mark track
         if self.rec_source == 'htk':
-            mark_file = HTKFile(self.dataset.htk_mark_path)
-            mark_track, meta = mark_file.read_data()
-            rate = mark_file.sample_rate
+            with HTKFile(self.dataset.htk_mark_path) as mark_file:
+                if mark_file.compressed:
+                    mark_track = mark_file.read_data()[:, 0]
+                else:
+                    # stream the track from a memory map, which stays valid after the file is closed
+                    mark_track = StreamIterator(mark_file.memmap()[:, 0], buffer_size=self.buffer_size)
+                rate = mark_file.sample_rate
         else:
+            self._wait_for('mrk1')
             mark_track, meta = self.rec_reader.get_data(stream='mrk1')
+            if isinstance(mark_track, StreamIterator):
+                # memory-mapped SEV store; event detection needs the single channel in memory
+                mark_track = mark_track.data[:, 0]
             rate = meta['sample_rate']
         return mark_track, rate
 
     def read_mark_events(self):
+        '''Read the onsets of the TDT mark epoc. These come from the TSQ records alone,
+        so they are available before any stream is decoded (see MarkManager.preview_mark_events()).
+        '''
         if self.rec_source == 'htk':
             return None
 
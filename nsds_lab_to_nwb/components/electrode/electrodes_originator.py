@@ -6,17 +6,23 @@ logger.setLevel(logging.DEBUG)
 
 
 class ElectrodesOriginator():
-    def __init__(self, metadata):
+    def __init__(self, metadata, drop_bad_chs=False):
         self.metadata = metadata
+        self.drop_bad_chs = drop_bad_chs   # bad channels are left out of the neural data
 
-    def make(self, nwb_content):
+    def make(self, nwb_content, channels=None):
+        '''Add the devices, electrode groups and electrodes, and return the electrode table region
+        of each device. channels is an optional dict of the ids of the channels read from each device
+        (see RecManager.get_channels), in the order of the neural data; the region of a device without
+        a channel list holds its ch_map (without the bad_chs if they are dropped).
+        '''
         logger.info('Creating devices...')
         self.__create_devices(nwb_content)
         logger.info('Creating electrode groups...')
         self.__create_electrode_groups(nwb_content)
         logger.info('Creating electrodes...')
         self.__add_electrodes(nwb_content)
-        electrode_table_regions = self.__create_electrode_table_regions(nwb_content)
+        electrode_table_regions = self.__create_electrode_table_regions(nwb_content, channels or {})
         return electrode_table_regions
 
     def __create_devices(self, nwb_content):
@@ -82,12 +88,20 @@ class ElectrodesOriginator():
                     bad=bad_flag)
             logger.debug(f' - Added all electrodes for electrode group {device_name}')
 
-    def __create_electrode_table_regions(self, nwb_content):
+    def __create_electrode_table_regions(self, nwb_content, channels):
         e_regions = {}
         for device_name in nwb_content.devices:
             # Collect device channel IDs for electrode table region
-            ch_map = self.metadata['device'][device_name]['ch_map']
-            electrode_region = [ch_map[i]['electrode_id'] for i in ch_map]
+            dev_conf = self.metadata['device'][device_name]
+            ch_map = dev_conf['ch_map']
+            if channels.get(device_name) is not None:
+                # the channels of the neural data, in its order
+                ch_map = {int(ch): ch_conf for ch, ch_conf in ch_map.items()}
+                electrode_region = [ch_map[ch]['electrode_id'] for ch in channels[device_name]]
+            else:
+                bad_chs = dev_conf.get('bad_chs') or []
+                electrode_region = [ch_map[i]['electrode_id'] for i in ch_map
+                                    if not (self.drop_bad_chs and i in bad_chs)]
 
             # Create the electrode table region for this device
             table_region = nwb_content.create_electrode_table_region(
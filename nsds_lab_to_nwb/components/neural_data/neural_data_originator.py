@@ -1,17 +1,23 @@
 import logging.config
+import numpy as np
+from hdmf.data_utils import AbstractDataChunkIterator
 from pynwb.ecephys import ElectricalSeries
+from pynwb.misc import DecompositionSeries
 
 from process_nwb.resample import resample
 
+from nsds_lab_to_nwb.components.neural_data.resample_iterator import ResampleIterator, to_dtype
+
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 
 
 class NeuralDataOriginator():
-    def __init__(self, rec_manager, metadata, resample_flag=True):
+    def __init__(self, rec_manager, metadata, resample_flag=True, keep_native_dtype=False):
         self.rec_manager = rec_manager
         self.metadata = metadata    # this should have all relevant metadata
         self.resample_flag = resample_flag
+        self.keep_native_dtype = keep_native_dtype  # e.g. keep int16 stores as int16 after resampling
         self.hardware_rate = None
         self.resample_rate = None
 
@@ -24,13 +30,20 @@ class NeuralDataOriginator():
             data, metadata = self.rec_manager.read_neural_data(stream=device_name, dev_conf=dev_conf)
             if data is None:
                 logger.info(f'No data available for {device_name}. Skipping...')
+            elif 'band_indices' in metadata:
+                # processed band data (e.g. high gamma) is kept at its own rate
+                self.make_decomposition_series(nwb_content, device_name, dev_conf, data, metadata,
+                                               electrode_table_regions[device_name])
             else:
                 # resample data
                 self.hardware_rate = metadata['sample_rate']
+                native_dtype = np.dtype(data.dtype).newbyteorder('=')  # e.g. big-endian HTK chunks
                 if self.resample_flag:
                     logger.info('Resampling to the nearest kHz...')
-                    data = self.resample(data)
+                    data = self.resample(data, dtype=native_dtype if self.keep_native_dtype else None)
                     logger.info('Resampling successful.')
+                if self.keep_native_dtype:
+                    data = self._to_dtype(data, native_dtype)
 
                 # make description
                 description = self._get_description(device_name)
@@ -47,20 +60,62 @@ class NeuralDataOriginator():
                                             description=description,
                                             comments=comments,
                                             conversion=dev_conf.get('conversion', 1.),
-                                            resolution=dev_conf.get('resolution', 1.)
+                                            resolution=self._get_resolution(dev_conf, data)
                                             )
                 logger.info(f'Adding {device_name} data to NWB...')
                 logger.debug(f' - Description: {description}')
                 logger.debug(f' - Comments: {comments}')
                 nwb_content.add_acquisition(e_series)
 
-    def resample(self, data):
+    def make_decomposition_series(self, nwb_content, device_name, dev_conf, data, metadata,
+                                  electrode_table_region):
+        '''Add band data of shape (time, channel, band) as a DecompositionSeries
+        to the 'ecephys' processing module.
+        '''
+        rate = metadata['sample_rate']
+        description = self.metadata['experiment_description']
+        description += '. Band data from {0:s} sampled at {1:f} Hz.'.format(device_name, rate)
+        series = DecompositionSeries(name=device_name,
+                                     data=data,
+                                     metric=dev_conf.get('metric', 'amplitude'),
+                                     description=description,
+                                     comments=self._get_comments(dev_conf),
+                                     source_channels=electrode_table_region,
+                                     starting_time=0.,
+                                     rate=rate * 1.0)
+        band_centers = metadata.get('bands')
+        band_limits = dev_conf.get('band_limits')
+        # band_limits lists all bands of the HTK files, band_centers only the selected ones
+        for i, band_index in enumerate(metadata['band_indices']):
+            series.add_band(band_name=f'band{band_index}',
+                            band_limits=band_limits[band_index] if band_limits is not None else (np.nan, np.nan),
+                            band_mean=band_centers[i] if band_centers is not None else np.nan)
+
+        if 'ecephys' in nwb_content.processing:
+            ecephys_module = nwb_content.processing['ecephys']
+        else:
+            ecephys_module = nwb_content.create_processing_module(name='ecephys',
+                                                                  description='processed ecephys data')
+        logger.info(f'Adding {device_name} band data to NWB...')
+        ecephys_module.add(series)
+
+    def resample(self, data, dtype=None):
+        '''Resample data to the nearest kHz below the hardware rate.
+
+        Data chunk iterators are resampled chunk by chunk with a polyphase filter as the
+        ElectricalSeries is written (see ResampleIterator), in the given dtype (default float32).
+        In-memory arrays are resampled at once.
+        '''
         # only resample if rate is not at nearest kHz
         rate = self.hardware_rate
         if (rate / 1000 % 1) > 0:
             new_freq = (rate // 1000) * 1000
             logger.info(f' - resampling from {rate} Hz to {new_freq} Hz')
-            new_data = resample(data, new_freq, rate)
+            if isinstance(data, AbstractDataChunkIterator):
+                logger.info(' - resampling chunk by chunk while writing')
+                new_data = ResampleIterator(data, new_freq, rate, dtype=dtype)
+            else:
+                new_data = resample(data, new_freq, rate)
             self.resample_rate = new_freq
             return new_data
         else:
@@ -69,6 +124,24 @@ class NeuralDataOriginator():
             self.resample_flag = False
             return data
 
+    @staticmethod
+    def _to_dtype(data, dtype):
+        '''Cast (resampled) data back to the dtype of the recording,
+        rounding to the nearest integer value for integer dtypes.
+        '''
+        if isinstance(data, AbstractDataChunkIterator) or data.dtype == dtype:
+            return data
+        logger.info(f' - converting data back to {dtype}')
+        return to_dtype(data, dtype)
+
+    def _get_resolution(self, dev_conf, data):
+        if 'resolution' in dev_conf:
+            return dev_conf['resolution']
+        if self.keep_native_dtype and np.issubdtype(data.dtype, np.integer):
+            # integer data resolves one count, i.e. one conversion step
+            return dev_conf.get('conversion', 1.)
+        return 1.
+
     def _get_description(self, device_name):
         description = self.metadata['experiment_description']
         description += '. Recordings from {0:s} sampled at {1:f} Hz.'.format(device_name,
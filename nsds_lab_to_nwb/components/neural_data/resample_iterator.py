@@ -0,0 +1,147 @@
+import logging.config
+from fractions import Fraction
+
+import numpy as np
+from hdmf.data_utils import AbstractDataChunkIterator, DataChunk
+from scipy.signal import firwin, upfirdn
+
+logger = logging.getLogger(__name__)
+
+
+MAX_RATE_DENOMINATOR = 10**5    # limits the up/down factors (and filter length) of odd rate ratios
+
+
+def polyphase_filter(up, down):
+    """Design the anti-aliasing FIR filter for resampling by up/down, as in scipy.signal.resample_poly.
+
+    Returns
+    -------
+    h: ndarray
+        Filter taps (Kaiser window, beta=5), scaled by up.
+    half_len: int
+        Delay of the filter in samples of the upsampled signal.
+    """
+    max_rate = max(up, down)
+    half_len = 10 * max_rate
+    h = firwin(2 * half_len + 1, 1. / max_rate, window=('kaiser', 5.0)) * up
+    return h, half_len
+
+
+def to_dtype(data, dtype):
+    """Cast resampled data to dtype, rounding to the nearest integer value for integer dtypes.
+    """
+    if np.issubdtype(dtype, np.integer):
+        dtype_info = np.iinfo(dtype)
+        data = np.rint(data, out=data)
+        data = np.clip(data, dtype_info.min, dtype_info.max, out=data)
+    return data.astype(dtype, copy=False)
+
+
+class ResampleIterator(AbstractDataChunkIterator):
+    """Resample the chunks of a time-major data chunk iterator with a polyphase FIR filter.
+
+    Chunks are resampled as they are read from the source iterator, keeping only the last
+    few input samples that the filter still needs for the next chunk (overlap-save), so memory
+    is bounded by the chunk size of the source rather than by the length of the recording.
+    The output equals scipy.signal.resample_poly of the whole recording (zero padded at the ends).
+
+    Parameters
+    ----------
+    data: AbstractDataChunkIterator
+        Source iterator of shape (time, ...), with chunks of consecutive samples in time order
+        that each span all other dimensions, e.g. a StreamIterator or HTKTimeIterator.
+    new_freq: float
+        Sampling rate to resample to.
+    old_freq: float
+        Sampling rate of the source.
+    dtype: numpy.dtype, optional
+        Dtype of the resampled chunks. Defaults to float32.
+    """
+    def __init__(self, data, new_freq, old_freq, dtype=None):
+        self.data = data
+        ratio = (Fraction(new_freq) / Fraction(old_freq)).limit_denominator(MAX_RATE_DENOMINATOR)
+        self.up, self.down = ratio.numerator, ratio.denominator
+        self.filter, self.half_len = polyphase_filter(self.up, self.down)
+        self.num_taps = -(-len(self.filter) // self.up)    # input samples per output sample
+        self.__dtype = np.dtype('float32') if dtype is None else np.dtype(dtype)
+
+        source_shape = tuple(data.maxshape)
+        num_samples = source_shape[0] * self.up
+        self.__maxshape = (num_samples // self.down + bool(num_samples % self.down),) + source_shape[1:]
+        # input samples that are still needed, starting with the zero padding before the first sample
+        self.buffer = np.zeros((self.num_taps,) + source_shape[1:], dtype='float32')
+        self.buffer_start = -self.num_taps
+        self.source_index = 0
+        self.current_index = 0
+
+    @property
+    def dtype(self):
+        return self.__dtype
+
+    @property
+    def maxshape(self):
+        return self.__maxshape
+
+    def __iter__(self):
+        """Return the iterator object"""
+        return self
+
+    def __next__(self):
+        """Return the next data chunk or raise a StopIteration exception if all chunks have been retrieved."""
+        while self.current_index < self.__maxshape[0]:
+            try:
+                self.__append(next(self.data))
+                # outputs whose last input sample has been read
+                stop_index = -(-(self.source_index * self.up - self.half_len) // self.down)
+                stop_index = min(stop_index, self.__maxshape[0])
+            except StopIteration:
+                # zero padding after the last sample
+                stop_index = self.__maxshape[0]
+                num_zeros = self.__last_input(stop_index) + 1 - self.source_index
+                if num_zeros > 0:
+                    self.buffer = np.concatenate(
+                        (self.buffer, np.zeros((num_zeros,) + self.buffer.shape[1:], dtype=self.buffer.dtype)))
+            if stop_index > self.current_index:
+                return self.__resample(stop_index)
+        raise StopIteration
+
+    def __last_input(self, index):
+        """Index of the last input sample needed for the outputs before index."""
+        return ((index - 1) * self.down + self.half_len) // self.up
+
+    def __append(self, chunk):
+        """Append a chunk of the source to the buffer."""
+        if chunk.selection[0].start != self.source_index or chunk.data.shape[1:] != self.buffer.shape[1:]:
+            raise ValueError('Resampling needs chunks of consecutive samples (of all channels) in time order, '
+                             f'got selection {chunk.selection} after {self.source_index} samples')
+        self.buffer = np.concatenate((self.buffer, np.asarray(chunk.data, dtype='float32')))
+        self.source_index += len(chunk.data)
+
+    def __resample(self, stop_index):
+        """Resample the outputs from current_index to stop_index and drop the inputs that are no longer needed."""
+        start_index = self.current_index
+        # upsampled position of the first output relative to the start of the buffer
+        offset = start_index * self.down + self.half_len - self.buffer_start * self.up
+        # shift the filter so that an output of upfirdn falls on the first output
+        first = -(-offset // self.down)
+        h = np.concatenate((np.zeros(first * self.down - offset), self.filter))
+        num_inputs = self.__last_input(stop_index) + 1 - self.buffer_start
+        resampled = upfirdn(h, self.buffer[:num_inputs], self.up, self.down, axis=0)
+        resampled = to_dtype(resampled[first:first + stop_index - start_index], self.__dtype)
+
+        self.current_index = stop_index
+        keep_start = self.__last_input(stop_index + 1) - self.num_taps + 1
+        if keep_start > self.buffer_start:
+            self.buffer = self.buffer[keep_start - self.buffer_start:].copy()
+            self.buffer_start = keep_start
+
+        selection = (slice(start_index, stop_index),) + tuple(slice(0, n) for n in self.__maxshape[1:])
+        return DataChunk(resampled, selection)
+
+    def recommended_chunk_shape(self):
+        """Recommend a chunk shape. None lets h5py choose."""
+        return None
+
+    def recommended_data_shape(self):
+        """Recommend an initial shape of the data: the full resampled recording."""
+        return self.maxshape
@@ -1,6 +1,7 @@
 import logging
 
 from nsds_lab_to_nwb.components.stimulus.utils import detect_events
+from nsds_lab_to_nwb.tools.stream_iterator import StreamIterator
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
@@ -17,14 +18,36 @@ class MarkManager():
         mark_track, mark_rate = self.rec_manager.read_marks()
 
         # detect marked event times
-        if self.rec_manager.rec_source == 'tdt' and self.use_tdt_mark_events:
-            mark_events = self.rec_manager.read_mark_events()
-        else:
-            mark_events = None
-        mark_events = self.get_mark_events(mark_events, mark_track, mark_rate)
+        mark_events = self.get_mark_events(self._read_tdt_mark_events(), mark_track, mark_rate)
 
         return mark_track, mark_rate, mark_events
 
+    def preview_mark_events(self):
+        ''' Find the same mark events as get_mark_track(), without keeping the mark track.
+        With use_tdt_mark_events, the events and the recording end time come from the TDT
+        headers, so no stream is read; otherwise the events are detected from the mark track.
+
+        Returns:
+        --------
+        mark_events: array of mark event times, in seconds.
+        rec_end_time: end time of the mark track, in seconds.
+        '''
+        mark_events = self._read_tdt_mark_events()
+        if mark_events is not None:
+            probe = self.rec_manager.probe()
+            mark_probe = probe['streams'].get('mrk1')
+            if mark_probe is not None:
+                return mark_events, mark_probe['num_samples'] / mark_probe['sample_rate']
+
+        mark_track, mark_rate, mark_events = self.get_mark_track()
+        num_samples = mark_track.maxshape[0] if isinstance(mark_track, StreamIterator) else len(mark_track)
+        return mark_events, num_samples / mark_rate
+
+    def _read_tdt_mark_events(self):
+        if self.rec_manager.rec_source == 'tdt' and self.use_tdt_mark_events:
+            return self.rec_manager.read_mark_events()
+        return None
+
     def get_mark_events(self, mark_events_input, mark_data, mark_rate):
         if mark_events_input is not None:
             # loaded directly from TDT object
@@ -38,6 +61,9 @@ class MarkManager():
         # although it doesn't hurt to keep
         stim_duration = self.stim_configs.get('duration', None)
         mark_threshold = self.stim_configs['mark_threshold']
+        if isinstance(mark_data, StreamIterator):
+            # scan the underlying (memory-mapped) track, leaving the iterator for writing
+            mark_data = mark_data.data
         mark_events = detect_events(mark_data, mark_rate, mark_threshold,
                                     min_separation=stim_duration)
         logger.debug(f'found {len(mark_events)} mark events')
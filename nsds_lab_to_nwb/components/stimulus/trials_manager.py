@@ -46,6 +46,16 @@ class TrialsManager():
         for trial_kwargs in trial_list:
             nwb_content.add_trial(**trial_kwargs)
 
+    def preview_trials(self, mark_events, rec_end_time):
+        ''' Tokenize without adding trials to the NWB file, e.g. to check the mark events
+        against the stimulus (nsamples) before reading any neural data.
+        Raises ValueError if they do not match.
+        A separate tokenizer is used, so that the state of self.tokenizer (e.g. the
+        audio_start_time) is only set by add_trials().
+        '''
+        tokenizer = type(self.tokenizer)(self.block_name, self.stim_configs)
+        return tokenizer.tokenize(mark_events, rec_end_time)
+
     def _already_tokenized(self, nwb_content):
         if not nwb_content.trials:
             return False
@@ -9,11 +9,26 @@ def read_wav(path):
     return data, rate, length
 
 
-def detect_events(mark_data, mark_rate, mark_threshold, min_separation=None):
-    mark_front_padded = np.concatenate((np.array([0.]), mark_data), axis=0)
-    thresh_crossings = np.diff((mark_front_padded > mark_threshold).astype('int'),
-                               axis=0)
-    mark_events_idx = np.where(thresh_crossings > 0.5)[0]
+DEFAULT_BLOCK_SIZE = 2**20    # samples per block scanned by detect_events
+
+
+def detect_events(mark_data, mark_rate, mark_threshold, min_separation=None,
+                  block_size=DEFAULT_BLOCK_SIZE):
+    '''Detect the times (in seconds) at which the mark track crosses the threshold upwards.
+    The track is scanned in blocks of block_size samples, carrying the state across blocks,
+    so mark_data can be any array-like that supports slicing (e.g. a memory map)
+    and only the blocks and the events are kept in memory.
+    '''
+    onsets = []
+    was_above = 0. > mark_threshold    # as if the track started with a 0
+    for start in range(0, len(mark_data), block_size):
+        above = np.ravel(mark_data[start:start + block_size]) > mark_threshold
+        rising = np.flatnonzero(above[1:] & ~above[:-1]) + 1
+        if above[0] and not was_above:
+            rising = np.concatenate(([0], rising))
+        onsets.append(rising + start)
+        was_above = above[-1]
+    mark_events_idx = np.concatenate(onsets) if onsets else np.array([], dtype=int)
     mark_events = mark_events_idx / mark_rate
 
     if min_separation is not None:
@@ -24,6 +24,12 @@ def convert_block(block_folder: str,
                   metadata_save_path=None,
                   resample_data=True,
                   use_htk=False,
+                  memmap_sev=False,
+                  drop_bad_chs=False,
+                  num_workers=None,
+                  cache_dir=None,
+                  keep_native_dtype=False,
+                  check_block=True,
                   process_stim=True,
                   write_nwb=True,
                   add_preprocessing=False):
@@ -48,7 +54,13 @@ def convert_block(block_folder: str,
                              metadata_save_path=metadata_save_path,
                              stim_lib_path=stim_lib_path,
                              resample_data=resample_data,
-                             use_htk=use_htk)
+                             use_htk=use_htk,
+                             memmap_sev=memmap_sev,
+                             drop_bad_chs=drop_bad_chs,
+                             num_workers=num_workers,
+                             cache_dir=cache_dir,
+                             keep_native_dtype=keep_native_dtype,
+                             check_block=check_block)
 
     # build the NWB file content
     nwb_content = nwb_builder.build(process_stim=process_stim)
@@ -49,6 +49,23 @@ class NWBBuilder:
         Passed to resample_flag kwarg in NeuralDataOriginator.
     use_htk : bool
         Use data from HTK files.
+    memmap_sev : bool
+        Memory-map TDT streams saved as SEV files, instead of decoding them into memory.
+    drop_bad_chs : bool
+        Leave the bad channels of each device out of the neural data (TDT only).
+    num_workers : int
+        Number of threads decoding TDT stores concurrently. Defaults to one per store;
+        1 decodes each store when it is needed.
+    cache_dir : str
+        Directory to cache the parsed TDT headers (or the index of the HTK directory) in,
+        for faster repeat conversions.
+    check_block : bool
+        Check the TDT block for missing stores and truncated files before converting,
+        and treat it as a bad block if any are found.
+    keep_native_dtype : bool
+        Keep the neural data in the dtype it was recorded in (e.g. int16) after resampling,
+        instead of float32. The scale to volts goes in the device conversion (and resolution).
+        Passed to keep_native_dtype kwarg in NeuralDataOriginator.
     """
 
     def __init__(
@@ -61,7 +78,13 @@ class NWBBuilder:
             stim_lib_path: str = None,
             metadata_save_path: str = None,
             resample_data=False,
-            use_htk=False
+            use_htk=False,
+            memmap_sev=False,
+            drop_bad_chs=False,
+            num_workers=None,
+            cache_dir=None,
+            keep_native_dtype=False,
+            check_block=True
     ):
         self.data_path = get_data_path(data_path)
         self.metadata_lib_path = get_metadata_lib_path(metadata_lib_path)
@@ -73,6 +96,15 @@ class NWBBuilder:
         self.metadata_save_path = metadata_save_path
         self.resample_data = resample_data
         self.use_htk = use_htk
+        self.memmap_sev = memmap_sev
+        self.drop_bad_chs = drop_bad_chs
+        self.num_workers = num_workers
+        self.cache_dir = cache_dir
+        self.keep_native_dtype = keep_native_dtype
+        self.check_block = check_block
+        if self.use_htk and self.drop_bad_chs:
+            logger.warning('drop_bad_chs is not supported for HTK data; keeping all channels.')
+            self.drop_bad_chs = False
 
         self.source_script, self.source_script_file_name = self._get_source_script()
 
@@ -97,13 +129,22 @@ class NWBBuilder:
         self.output_file = os.path.join(rat_out_dir, f'{self.block_folder}.nwb')
 
         logger.info('Initializing recordings manager...')
-        self.rec_manager = RecManager(self.dataset)
+        self.rec_manager = RecManager(self.dataset, self.metadata, memmap_sev=self.memmap_sev,
+                                      drop_bad_chs=self.drop_bad_chs,
+                                      num_workers=self.num_workers,
+                                      cache_dir=self.cache_dir)
+        if self.check_block and self._check_damaged_block():
+            self.bad_block = True
+            logger.info('Damaged block. Escaping __init__ before originators.')
+            return
 
         logger.info('Creating originator instances...')
-        self.electrodes_originator = ElectrodesOriginator(self.metadata)
+        self.electrodes_originator = ElectrodesOriginator(self.metadata,
+                                                          drop_bad_chs=self.drop_bad_chs)
         self.neural_data_originator = NeuralDataOriginator(self.rec_manager,
                                                            self.metadata,
-                                                           resample_flag=self.resample_data)
+                                                           resample_flag=self.resample_data,
+                                                           keep_native_dtype=self.keep_native_dtype)
         self.stimulus_originator = StimulusOriginator(self.rec_manager,
                                                       self.dataset, self.metadata)
 
@@ -159,6 +200,18 @@ class NWBBuilder:
 
         return bad_block, incomplete_block
 
+    def _check_damaged_block(self):
+        report = self.rec_manager.check_block()
+        if report is None:
+            # HTK
+            return False
+        for issue in report['issues']:
+            if issue['fatal']:
+                logger.warning(f"* Damaged block: {issue['message']}")
+            else:
+                logger.info(f"* {issue['message']}")
+        return not report['ok']
+
     def _collect_dataset_paths(self):
         # scan data_path and identify relevant subdirectories
         if self.experiment_type == 'auditory':
@@ -190,6 +243,25 @@ class NWBBuilder:
             nwb_content.add_scratch(data=[value],
                                     name=key, notes=f'extra metadata {key}')
 
+    def preview_trials(self):
+        '''Tokenize trials from the same mark events that build() uses, without reading
+        the neural data. This checks the marks against the stimulus (e.g. nsamples)
+        before committing to reading the neural data. Raises ValueError if they do not match.
+
+        Returns:
+        --------
+        trial_list: list of trial kwargs,
+                or None for a bad block.
+        '''
+        if self.bad_block:
+            logger.info('Looks like a bad block. Not previewing trials.')
+            return None
+
+        mark_events, rec_end_time = self.stimulus_originator.mark_manager.preview_mark_events()
+        trial_list = self.stimulus_originator.trials_manager.preview_trials(mark_events, rec_end_time)
+        logger.info(f'Found {len(trial_list)} trials from the marks.')
+        return trial_list
+
     def build(self, process_stim=True):
         '''Build NWB file content.
 
@@ -239,7 +311,10 @@ class NWBBuilder:
         self._add_extra_metadata(nwb_content)
 
         logger.info('Adding electrode information...')
-        electrode_table_regions = self.electrodes_originator.make(nwb_content)
+        # the electrode table regions list the same channels, in the same order, as the neural data
+        channels = {device_name: self.rec_manager.get_channels(device_name, dev_conf)
+                    for device_name, dev_conf in self.metadata['device'].items() if isinstance(dev_conf, dict)}
+        electrode_table_regions = self.electrodes_originator.make(nwb_content, channels=channels)
 
         logger.info('Adding neural data...')
         self.neural_data_originator.make(nwb_content, electrode_table_regions)
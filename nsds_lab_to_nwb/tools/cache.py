@@ -0,0 +1,36 @@
+import hashlib
+import os
+
+import numpy as np
+
+
+def keyed_cache_path(cache_dir, prefix, *key):
+    """Get the path of a .npz cache file, named by a prefix and the sha1 of a key.
+
+    Parameters
+    ----------
+    cache_dir: str
+        Directory of the cache files.
+    prefix: str
+        Readable start of the file name, e.g. the name of the cached block or directory.
+    key: values that identify the cached content, e.g. a path and its modification time.
+        They are joined with ':', so any change in them gives a new file name.
+
+    Returns
+    -------
+    cache_path: str
+        Path to the .npz cache file.
+    """
+    key = ':'.join(str(value) for value in key)
+    return os.path.join(cache_dir, f'{prefix}_{hashlib.sha1(key.encode()).hexdigest()}.npz')
+
+
+def save_npz(path, **arrays):
+    """Save arrays to a .npz cache file, as np.savez does.
+
+    The arrays are written to a temporary file first, which then replaces path,
+    so a partial file is never read back (e.g. by another process converting a block).
+    """
+    tmp_path = path[:-len('.npz')] + f'.{os.getpid()}.tmp.npz'
+    np.savez(tmp_path, **arrays)
+    os.replace(tmp_path, path)
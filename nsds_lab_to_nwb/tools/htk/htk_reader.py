@@ -1,4 +1,5 @@
 import logging.config
+import os
 
 from nsds_lab_to_nwb.tools.htk.readers.instrument import EPhysInstrumentData
 
@@ -14,9 +15,13 @@ class HTKReader:
         Path to HTK folder
     channels: list, optional
         List of channel ids to import. Defaults to None.
+    cache_dir: str, optional
+        Directory to cache the index of the HTK directory in (see htkindex.get_directory_index).
+        Defaults to None (the index is only shared in memory, across devices).
     """
-    def __init__(self, path, channels=None):
+    def __init__(self, path, channels=None, cache_dir=None):
         self.path = path
+        self.cache_dir = cache_dir
 
     def get_data(self, *, stream=None, dev_conf=None):
         """Get specified data
@@ -27,23 +32,45 @@ class HTKReader:
             Stream name (not used by HTKReader)
         dev_conf: (dict) metadata for the device.
             nwb_builder.metadata['device'][device_name]. Not used for TDT.
+            Optional keys for processed, multi-band HTK data: 'htk_dir', the directory with the
+            processed HTK files (e.g. 'HilbAA_70to150_8band'; relative to the parent of the
+            raw HTK folder), and 'bands', the list of band indices to read (default: all bands
+            of the processed HTK files if 'htk_dir' is given).
 
         Returns
         -------
-        data: ndarray
-            Data array
+        data: AbstractDataChunkIterator
+            Data iterator of shape (time, channel), or (time, channel, band) for processed HTK data.
+            Its dtype may be big-endian.
         meta: dict
-            Meta data for the data array.
+            Meta data for the data array. For processed HTK data, also 'band_indices' (the selected bands)
+            and 'bands' (their center frequencies, guessed from the directory name, or None).
         """
+        htkdir = self.path
+        htkcollection_kwargs = {}
+        if 'htk_dir' in dev_conf:
+            htkdir = os.path.join(os.path.dirname(os.path.normpath(self.path)), dev_conf['htk_dir'])
+            htkcollection_kwargs['guess_bands'] = True
+        bands = dev_conf.get('bands')
+        has_bands = bands is not None or 'htk_dir' in dev_conf
         device_reader = EPhysInstrumentData(
-            htkdir=self.path,
+            htkdir=htkdir,
             prefix=dev_conf['prefix'],
             postfix=dev_conf['ch_ids'],
             device_name=dev_conf['device_type'],
-            read_on_create=False)
-        device_reader.read_data(create_iterator=True, time_axis_first=True, has_bands=False)
+            read_on_create=False,
+            use_memmap=True,
+            cache_dir=self.cache_dir,
+            **htkcollection_kwargs)
+        # only the selected bands are read; uncompressed samples are copied into the chunks as they are
+        # stored (big-endian), and HDF5 converts them while writing
+        device_reader.read_data(create_iterator=True, time_axis_first=True, has_bands=has_bands,
+                                iterate_over_time=True, bands=bands, native_byte_order=False)
 
         data = device_reader.data
         meta = {}
         meta['sample_rate'] = device_reader.sample_rate
+        if has_bands:
+            meta['band_indices'] = list(bands) if bands is not None else list(range(data.maxshape[2]))
+            meta['bands'] = device_reader.bands
         return data, meta
@@ -1,9 +1,14 @@
+import logging
 import os
+import time
 import warnings
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import numpy as np
 
-from .htkfile import HTKFile
+from .htkfile import HTKFile, HTKFilePool, HTKFormat, header_mismatches
+from .htkindex import get_directory_index
+from .htkshared import SharedHTKData
 
 """
 Module used for reading of collections of HTK files of raw or processed neural recordings.
@@ -55,6 +60,8 @@ prepare derivative works, incorporate into other computer software, distribute,
 sublicense such enhancements or derivative works thereof, in binary and source code form.
 """
 
+logger = logging.getLogger(__name__)
+
 
 class HTKCollection(object):
     """
@@ -82,6 +89,12 @@ class HTKCollection(object):
             should we should divide the sampling rate given in the header by in order to convert the
             rate to the appropriate value in Hz.
     :var bands: 1D numpy array with center of the frequency bands
+    :ivar headers: 1D structured numpy array with the raw header of each HTK file (see htkfile.read_headers)
+    :ivar file_pool: HTKFilePool with the open HTK files of the collection. Call close() (or use the
+            collection as a context manager) to close them.
+    :ivar shared_data: SharedHTKData describing the shared memory segment holding self.data if the data
+            was read with read_data(shared=True), None otherwise. Worker processes get the data from
+            shared_data.attach() without copying or reading the HTK files again.
     """
     def __init__(self,
                  directory,
@@ -90,10 +103,13 @@ class HTKCollection(object):
                  anatomy_file=None,
                  bands_file=None,
                  guess_bands=False,
-                 check_consistency=False,
+                 check_consistency=True,
                  sample_rate_base=10000.,
                  noblock=True,
-                 postfix=None):
+                 postfix=None,
+                 max_open_files=64,
+                 use_memmap=False,
+                 cache_dir=None):
         """
         Initialize object for management of directory of RAW neural recording in HTK format.
 
@@ -113,7 +129,8 @@ class HTKCollection(object):
         :type bands_file: String indicating the name of the .mat Matlab file.
         :param guess_bands: If no bands file is given, should we guess the bands from the file-name.
         :type guess_bands: Boolean
-        :param check_consistency: Check that all HTK files in the collection have the same structure.
+        :param check_consistency: Check that all HTK files in the collection have the same structure
+                                  (see check_consistency()) (default=True)
         :type check_consistency: Boolean
         :param sample_rate_base: None if the sample_period is given in the header. Set to the number that
             should we should divide the sampling rate given in the header by in order to convert the
@@ -121,8 +138,12 @@ class HTKCollection(object):
         :param noblock: Boolean to indicate that no block index is given in the filename (default=True)
         :type noblock: bool
         :param postfix: Tuple of valid postfix strings values or numpy array of ints with the file index values
+        :param max_open_files: Maximum number of HTK files kept open at the same time (default=64)
+        :param use_memmap: Read the HTK files through memory maps (see HTKFile.memmap) (default=False)
+        :param cache_dir: Directory to cache the index of the HTK directory in (see htkindex.get_directory_index).
+                          Set to None to only share the index in memory (default=None)
 
-        :raises: AssertionError is raised if check_consistency if enabled and inconsistencies
+        :raises: ValueError is raised if check_consistency if enabled and inconsistencies
                  in metadata are found between HTK files in the collection.
 
         """
@@ -131,12 +152,22 @@ class HTKCollection(object):
         self.prefix = prefix
         self.noblock = noblock
         self.postfix = postfix if postfix is None else postfix
-        self.htk_files, self.channel_to_file_map, self.file_to_channel_map = self.__get_htk_files()
+        self.file_pool = HTKFilePool(max_open_files=max_open_files, sample_rate_base=sample_rate_base,
+                                     use_memmap=use_memmap)
+        self.htk_files, self.channel_to_file_map, self.file_to_channel_map, self.headers = \
+            self.__get_htk_files(cache_dir=cache_dir)
+        if check_consistency:
+            mismatches = self.check_consistency()
+            if mismatches:
+                raise ValueError('Inconsistent HTK headers in %s: %s' % (
+                    self.directory,
+                    ', '.join('%s differs in %i files (e.g., %s)'
+                              % (name, len(fileindices), os.path.basename(self.htk_files[fileindices[0]]))
+                              for name, fileindices in mismatches.items())))
         self.data = None
+        self.shared_data = None
         (self.num_samples, self.sample_period, self.sample_rate, self.sample_size,
          self.parameter_kind, self.num_bands, self.dtype) = self.__get_htk_metadata()
-        if check_consistency:
-            assert self.__check_consistency()
         if layout is None:
             self.layout = self.get_layout(len(self.htk_files))
         else:
@@ -261,7 +292,7 @@ class HTKCollection(object):
         NOTE! This function assumes that the list of htk_files has already been computed.
         """
         if len(self.htk_files) > 0:
-            tempfile = HTKFile(self.htk_files[0], sample_rate_base=self.sample_rate_base)
+            tempfile = self.file_pool.get(self.htk_files[0])
             num_samples = tempfile.num_samples
             sample_period = tempfile.sample_period
             sample_rate = tempfile.sample_rate
@@ -269,112 +300,76 @@ class HTKCollection(object):
             parameter_kind = tempfile.parameter_kind
             num_bands = tempfile.vector_length
             dtype = tempfile.read_sample(0).dtype
-            del tempfile
             return num_samples, sample_period, sample_rate, sample_size, parameter_kind, num_bands, dtype
 
-    def __check_consistency(self):
+    def check_consistency(self):
         """
-        Internal helper function used to check that all HTK files in the collection
-        have the same structure (i.e, whether the header information of the HTK files
-        is the same for all files).
-        NOTE! This function assumes that the list of htk_files has already been computed.
+        Check that all HTK files in the collection have the same structure, i.e., whether the
+        header information of the HTK files is the same for all files. The headers are taken
+        from the directory index (see htkindex.get_directory_index), without opening the files.
+
+        :returns: Dict with, for each header field that is not the same in all files, a numpy array of
+                  the indices of the files whose value differs from the first file (see htkfile.header_mismatches).
+                  An empty dict means that the collection is consistent.
         """
-        if len(self.htk_files) <= 1:
-            return True
-        else:
-            consistent = True
-            tempfile = HTKFile(self.htk_files[0], sample_rate_base=self.sample_rate_base)
-            num_samples1 = tempfile.num_samples
-            sample_period1 = tempfile.sample_period
-            sample_rate1 = tempfile.sample_rate
-            sample_size1 = tempfile.sample_size
-            parameter_kind1 = tempfile.parameter_kind
-            del tempfile
-            for filename in self.htk_files:
-                tempfile = HTKFile(filename, sample_rate_base=self.sample_rate_base)
-                num_samples2 = tempfile.num_samples
-                sample_period2 = tempfile.sample_period
-                sample_rate2 = tempfile.sample_rate
-                sample_size2 = tempfile.sample_size
-                parameter_kind2 = tempfile.parameter_kind
-                consistent &= num_samples1 != num_samples2 or \
-                    sample_period1 != sample_period2 or \
-                    sample_rate1 != sample_rate2 or \
-                    sample_size1 != sample_size2 or \
-                    parameter_kind1 != parameter_kind2
-                del tempfile
-                if not consistent:
-                    break
-            return consistent
+        return header_mismatches(self.headers)
 
-    def __get_htk_files(self):
+    def __get_htk_files(self, cache_dir=None):
         """
         Internal helper function used to compute the list of files
         (stored in self.htk_files) and the map of files to channels/blocks
-        (stored in self.channel_block_map).
+        (stored in self.channel_block_map), from the index of the directory.
+
+        :param cache_dir: Directory to cache the index of the HTK directory in (see htkindex.get_directory_index)
 
         :returns: This function returns: i) a list of htk filenames,
                   ii) a 2D numpy array of shape (#blocks, #channels)
                   indicating the index of the file associated with
-                  a given channel, and iii) a list of tuples indicating
-                  for each file the block and channel index.
+                  a given channel, iii) a list of tuples indicating
+                  for each file the block and channel index, and iv) the
+                  headers of the files.
 
         :raises: A ValueError is raised in case that HTK files of varying sizes are found.
 
         """
-        # Compute the list of all htk files
-        filelist = [os.path.join(self.directory, filename)      # Record the full path off all htk files
-                    for filename in os.listdir(self.directory)  # Iterate through all files in the directory
-                    if filename.endswith('.htk')]               # Record all HTK files
-        # print(filelist)
-        if self.prefix is not None: # Remove all files from the list that do not have the approbriate prefix
-            filelist = [filename for filename in filelist if os.path.basename(filename).startswith(self.prefix)]
-            # print([os.path.basename(filename) for filename in filelist])
+        # Get the list of all htk files from the (shared) index of the directory
+        index = get_directory_index(self.directory, cache_dir=cache_dir)
+        selection = np.ones(len(index), dtype=bool)
+        if self.prefix is not None:  # Remove all files from the list that do not have the approbriate prefix
+            selection &= np.char.startswith(index.filenames, self.prefix)
         if isinstance(self.postfix, tuple):  # Remove all files that do not have a given postfix
-            filelist = [filename for filename in filelist if filename[:-4].endswith(self.postfix)]
-            print(filelist)
+            selection &= np.array([filename[:-4].endswith(self.postfix) for filename in index.filenames],
+                                  dtype=bool)
+        selection = np.flatnonzero(selection)
         if isinstance(self.postfix, np.ndarray):
-            temp_list = []
-            for filename in filelist:
-                bi, ci = self.__get_block_channel_index_from_name(filename, self.noblock)
-                if self.noblock:
-                    if ci in self.postfix:
-                        temp_list.append(filename)
-                else:
-                    if int(str(bi) + str(ci)) in self.postfix:
-                        temp_list.append(filename)
-            filelist = temp_list
+            selection = selection[self.__select_postfix(index, selection)]
 
         # Check if we have any files and warn the user if the folder did not contain any valid HTK files
-        if len(filelist) == 0:
+        if len(selection) == 0:
             warnings.warn('No HTK files found in the given data directory.')
-            return [], np.zeros((0, 0), dtype='uint64'), []
+            return [], np.zeros((0, 0), dtype='uint64'), [], index.headers[:0]
         # Check if all files in the list have the same size
-        filesizes = np.asarray([os.path.getsize(path) for path in filelist])
+        filesizes = index.sizes[selection]
         if len(np.unique(filesizes)) != 1:
             raise ValueError('HTK files of varying size found in the same location. Try to set the prefix filter')
 
         # Compute based on the filename the block and channel index
-        blockindex = [-1] * len(filelist)
-        channelindex = [-1] * len(filelist)
-        for fileindex, filepath in enumerate(filelist):
-            blockindex[fileindex], channelindex[fileindex] = self.__get_block_channel_index_from_name(filepath,
-                                                                                                      self.noblock)
-        blockindex = np.asarray(blockindex)
-        channelindex = np.asarray(channelindex)
+        blockindex, channelindex = index.block_channel_index(self.noblock, selection)
         numblocks = blockindex.max()
         numchannels = channelindex.max()
         blockindex -= 1  # In the file name encoding block indicies are 1 based
         channelindex -= 1  # In the file name encoding channel indicies are 1 based
         if channelindex.min() > 0:
-            numchannels = len(filelist)
+            numchannels = len(selection)
             channelindex -= channelindex.min()
 
-        # Sort the files based on their block and channel index
-        filelist, blockindex, channelindex = self.__sort_files(filelist=filelist,
-                                                               blockindex=blockindex,
-                                                               channelindex=channelindex,
-                                                               numchannels=numchannels)
+        # Sort the files (given by their position in the index) based on their block and channel index
+        selection, blockindex, channelindex = self.__sort_files(filelist=selection,
+                                                                blockindex=blockindex,
+                                                                channelindex=channelindex,
+                                                                numchannels=numchannels)
+        filelist = [os.path.join(self.directory, index.filenames[i]) for i in selection]
+        headers = index.headers[selection]
         # Compute the channel+block to file map
         cbmap = np.zeros(shape=(numblocks, numchannels), dtype='uint64')
         for fileindex in range(len(filelist)):
@@ -383,8 +378,20 @@ class HTKCollection(object):
         # Compute the file to block+channel map
         fmap = list(zip(blockindex, channelindex))
 
-        # Return the filelist and maps
-        return filelist, cbmap, fmap
+        # Return the filelist, maps and headers
+        return filelist, cbmap, fmap, headers
+
+    def __select_postfix(self, index, selection):
+        """
+        Internal helper function used to find the files of the selection whose
+        index value (channel index, or block and channel index) is in self.postfix.
+
+        :returns: 1D boolean numpy array indicating for each file of the selection whether it is selected
+        """
+        blockindex, channelindex = index.block_channel_index(self.noblock, selection)
+        if self.noblock:
+            return np.isin(channelindex, self.postfix)
+        return np.isin([int(str(bi) + str(ci)) for bi, ci in zip(blockindex, channelindex)], self.postfix)
 
     @staticmethod
     def __sort_files(filelist, blockindex, channelindex, numchannels):
@@ -413,37 +420,6 @@ class HTKCollection(object):
         # Return the sorted files, blockindex, and channelindex
         return outfilelist, outblockindex, outchannelindex
 
-    @staticmethod
-    def __get_block_channel_index_from_name(filename, noblock=False):
-        """
-        Internal helper function used to determine the block index
-        and channel index based on the name of the file.
-
-        :param filename: Name of the HTK file
-        :type filename: string
-        :param noblock: Boolean to indicate that no block index is given in the filename (default=False)
-        :type noblock: bool
-
-        :returns: Integer of the block index and integer of the channel index within the block
-        """
-        basename = os.path.basename(filename).rstrip('.htk')
-        # Get all digits at the end of the filename
-        indexstring = ""
-        for endchar in reversed(basename):
-            if endchar.isdigit():
-                indexstring = endchar + indexstring
-            else:
-                break
-        # Calculate the block and channel index from the string
-        if noblock:
-            channelindex = int(indexstring)
-            blockindex = 1
-        else:
-            blockindex = int(indexstring[0])
-            channelindex = int(indexstring[1:])
-        # Retrun the block and channelindex
-        return blockindex, channelindex
-
     def get_anatomy_dict(self):
         """
         Get the anatomy dicitionary describing for each region
@@ -519,22 +495,71 @@ class HTKCollection(object):
 
     def clear_data(self):
         """
-        Clear the self.data instance variable to free up memory.
+        Clear the self.data instance variable to free up memory. If the data is in shared memory,
+        only the handle of the collection is closed; arrays returned by read_data() remain valid,
+        and the segment remains available to other processes until unlink_shared_data() is called.
         """
         del self.data
         self.data = None
+        if self.shared_data is not None:
+            self.shared_data.close()
+
+    def unlink_shared_data(self):
+        """
+        Clear the data and destroy the shared memory segment of read_data(shared=True), once no other
+        process needs to attach to it anymore. Arrays that are still in use keep the memory mapped.
+        """
+        self.clear_data()
+        if self.shared_data is not None:
+            self.shared_data.unlink()
+            self.shared_data = None
+
+    def close(self):
+        """
+        Close all HTK files of the collection that are still open.
+        """
+        self.file_pool.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
 
     def read_channel(self, fileindex):
         """
         Get the data for the file with the given index.
         """
-        if self.data:
+        if self.data is not None:
             return self.data[fileindex]
         else:
-            tempfile = HTKFile(self.htk_files[fileindex], sample_rate_base=self.sample_rate_base)
-            return tempfile.read_data()
+            tempfile = self.file_pool.get(self.htk_files[fileindex])
+            data = tempfile.read_data()
+            tempfile.clear_data()  # the pooled file should not hold on to the data
+            return data
+
+    def read_channel_range(self, fileindex, start, stop, bands=None, out=None):
+        """
+        Get the data of the samples in the range [start, stop) for the file with the given index,
+        without reading the rest of the file.
+
+        :param bands: Optional list (or slice) of the bands to be read (see HTKFile.read_range)
+        :param out: Optional array of shape (stop - start, #bands) to read all bands into (see HTKFile.read_into),
+                    e.g., a slice of a chunk of several channels, in native or big-endian byte order.
+        """
+        if out is not None:
+            if bands is not None:
+                raise ValueError('Cannot read a selection of bands into out')
+            if self.data is not None:
+                out[...] = self.data[fileindex, start:stop]
+                return out
+            return self.file_pool.get(self.htk_files[fileindex]).read_into(out, start=start)
+        if self.data is not None:
+            return self.data[fileindex, start:stop] if bands is None else self.data[fileindex, start:stop, bands]
+        else:
+            return self.file_pool.get(self.htk_files[fileindex]).read_range(start, stop, bands=bands)
 
-    def read_data(self, print_status=False):
+    def read_data(self, print_status=False, workers=1, shared=False):
         """
         Read all data from file and return the numpy array.
         This function modifies self.data to safe the data
@@ -543,6 +568,13 @@ class HTKCollection(object):
         :param print_status: One of [True, False, 'jupyter']. True means-Print status message on
                         read progress on screen. 'jupyter' means create a progress bar in a Jupyter notebook.
                         False means, don't show process. Default is False.
+        :param workers: Number of threads reading HTK files concurrently (default=1). Each thread opens
+                        its own files and reads them directly into self.data, so reads of different
+                        channels overlap (numpy releases the GIL while reading).
+        :param shared: Read the data into a shared memory segment (default=False), so that other processes
+                       can use it without decoding the HTK files again. Send self.shared_data to the
+                       worker processes, which call its attach() method to get the data. The segment
+                       is destroyed by unlink_shared_data().
         """
         if print_status is True:
             import sys
@@ -553,7 +585,17 @@ class HTKCollection(object):
         if self.data is None:
             # Read all HTK data files in order of appearance in the map
             # datalist = [None]*len(self.htk_files)
-            self.data = np.zeros(shape=self.shape, dtype=self.dtype)
+            if shared:
+                if self.shared_data is None:
+                    self.shared_data = SharedHTKData.create(self.shape, self.dtype, sample_rate=self.sample_rate)
+                self.data = self.shared_data.attach()
+            else:
+                self.data = np.empty(shape=self.shape, dtype=self.dtype)
+            start_time = time.perf_counter()
+            if workers > 1:
+                self.__read_files_concurrently(workers, print_status)
+                self.__log_throughput(time.perf_counter() - start_time)
+                return self.data
             loop_var = enumerate(self.htk_files)
             if print_status == 'jupyter':
                 loop_var = log_progress(loop_var, every=1, size=len(self.htk_files),
@@ -564,17 +606,86 @@ class HTKCollection(object):
                                      str(int(100. * float(fileindex) / float(len(self.htk_files) - 1))) +
                                      "%]" + "\r")
                     sys.stdout.flush()
-                tempfile = HTKFile(filename, sample_rate_base=self.sample_rate_base)
+                tempfile = self.file_pool.get(filename)
                 # datalist[fileindex] = tempfile.read_data()
-                self.data[fileindex] = tempfile.read_data()
-                del tempfile
+                tempfile.read_into(self.data[fileindex])
             if print_status:
                 print('')
             # Convert the data to numpy and make sure we have a 2D shaped array if we only have one frequency band
             # self.data = np.asarray(datalist)
+            self.__log_throughput(time.perf_counter() - start_time)
         # Return the full data
         return self.data
 
+    def __read_file(self, fileindex):
+        """
+        Internal helper function used to read a single HTK file into self.data from a worker thread.
+        The file is opened by the thread itself rather than taken from the shared file pool.
+        """
+        with HTKFile(self.htk_files[fileindex], sample_rate_base=self.sample_rate_base,
+                     use_memmap=self.file_pool.use_memmap) as tempfile:
+            tempfile.read_into(self.data[fileindex])
+
+    def __read_files_concurrently(self, workers, print_status=False):
+        """
+        Internal helper function used to read all HTK files into self.data with a pool of worker threads.
+        """
+        import sys
+        num_files = len(self.htk_files)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(self.__read_file, fileindex) for fileindex in range(num_files)]
+            for num_done, future in enumerate(as_completed(futures), start=1):
+                future.result()  # raise any error from reading the file
+                if print_status:
+                    sys.stdout.write("Reading HTK Collection: [" + str(int(100. * num_done / num_files)) +
+                                     "%]" + "\r")
+                    sys.stdout.flush()
+        if print_status:
+            print('')
+
+    def __log_throughput(self, elapsed_time):
+        """
+        Internal helper function used to report the read throughput of read_data.
+        """
+        num_megabytes = self.data.nbytes / 1e6
+        logger.info('Read %.1f MB from %i HTK files in %.2f s (%.1f MB/s)'
+                    % (num_megabytes, len(self.htk_files), elapsed_time,
+                       num_megabytes / max(elapsed_time, 1e-9)))
+
+
+DEFAULT_BUFFER_BYTES = 64 * 2**20
+"""
+Default target size in bytes of the chunks returned by HTKChannelIterator.__next__
+"""
+
+DEFAULT_CHUNK_BYTES = 2**20
+"""
+Default target size in bytes of the HDF5 chunks recommended by HTKChannelIterator
+"""
+
+
+def select_bands(num_bands, bands=None, has_bands=True):
+    """
+    Helper function used by the iterators to determine the bands to be read from the HTK files.
+
+    :param num_bands: Number of bands in the HTK files
+    :param bands: List of the indices of the bands to be read, or None to read all bands
+    :param has_bands: If False, the band dimension is dropped, so only a single band is read
+                      (the first band if bands is None)
+
+    :returns: List of the indices of the bands to be read, or None if all bands are read in order
+
+    :raises: ValueError is raised if has_bands is False and more than one band is selected.
+    """
+    if bands is None:
+        bands = list(range(num_bands)) if has_bands else [0]
+    bands = [int(band) for band in np.arange(num_bands)[bands]]
+    if not has_bands and len(bands) != 1:
+        raise ValueError('A single band must be selected if has_bands is False, got %i' % len(bands))
+    if bands == list(range(num_bands)):
+        return None
+    return bands
+
 
 try:
     # from form.data_utils import DataChunkIterator, DataChunk
@@ -584,6 +695,7 @@ try:
     class HTKChannelIterator(AbstractDataChunkIterator):
         """
         Custom data chunk iterator to iterate over the channels of an HTK collection.
+        Each chunk holds the data of a block of consecutive channels.
         """
         # @docval({'name': 'data', 'type': HTKCollection, 'doc': 'The HTKCollection to iterate over.'})
         def __init__(self, **kwargs):
@@ -594,9 +706,13 @@ try:
             self.time_axis_first = getargs('time_axis_first', kwargs)
             self.__maxshape = list(getargs('maxshape', kwargs))
             self.__has_bands = getargs('has_bands', kwargs)
+            # Bands to be read (None for all bands)
+            self.bands = select_bands(int(self.data.num_bands), kwargs.get('bands'), self.__has_bands)
+            self.num_bands = int(self.data.num_bands) if self.bands is None else len(self.bands)
+            self.__maxshape[2] = self.num_bands
             if self.time_axis_first:
                 # Swap the axes on the shape and maxshape
-                self.shape = (self.data.shape[1], self.data.shape[0], self.data.shape[2])
+                self.shape = (self.data.shape[1], self.data.shape[0], self.num_bands)
                 self.__maxshape[0], self.__maxshape[1] = self.__maxshape[1], self.__maxshape[0]
                 self.__maxshape = tuple(self.__maxshape)
                 if not self.__has_bands:
@@ -604,21 +720,40 @@ try:
                     self.__maxshape = self.__maxshape[0:2]
 
             else:
-                self.shape = self.data.shape
+                self.shape = (self.data.shape[0], self.data.shape[1], self.num_bands)
+                self.__maxshape = tuple(self.__maxshape)
+            # Number of channels per chunk; computed from the target size in bytes if not given
+            self.buffer_size = kwargs.get('buffer_size')
+            if self.buffer_size is None:
+                buffer_bytes = kwargs.get('buffer_bytes') or DEFAULT_BUFFER_BYTES
+                self.buffer_size = max(1, int(buffer_bytes // self.__channel_bytes()))
+            self.buffer_size = int(min(self.buffer_size, max(1, self.data.get_number_of_files())))
 
         @classmethod
-        def from_htk_collection(cls, collection, time_axis_first=False, has_bands=True):
+        def from_htk_collection(cls, collection, time_axis_first=False, has_bands=True,
+                                buffer_size=None, buffer_bytes=DEFAULT_BUFFER_BYTES, bands=None):
             """
             Convenience function to generate a HTKChannelIterator from an existing HTKCollection
             :param collection: The input HTKCollection for which we should create an iterator
             :type collection: HTKCollection
+            :param buffer_size: Number of channels per chunk. Computed from buffer_bytes if None.
+            :param buffer_bytes: Target size in bytes of each chunk (default=64MB), used if buffer_size is None
+            :param bands: List of the indices of the bands to be read (see select_bands). Only the selected
+                          bands are converted and kept in memory. Set to None to read all bands (default=None)
             :return: HTKChannelIterator for the input HTKCollection
             """
             return cls(data=collection,
                        maxshape=collection.shape,
                        dtype=collection.dtype,
                        time_axis_first=time_axis_first,
-                       has_bands=has_bands)
+                       has_bands=has_bands,
+                       buffer_size=buffer_size,
+                       buffer_bytes=buffer_bytes,
+                       bands=bands)
+
+        def __channel_bytes(self):
+            """Number of bytes of the data of a single channel"""
+            return int(self.data.num_samples) * self.num_bands * np.dtype(self.__dtype).itemsize
 
         @property
         def maxshape(self):
@@ -634,42 +769,50 @@ try:
 
         def __next__(self):
             """Return the next data chunk or raise a StopIteration exception if all chunks have been retrieved."""
-            next_chunk = []
             # Determine the range of channels to be read
             start_index = self.current_fileindex
-            stop_index = start_index + 1  # self.buffer_size
-            if stop_index > self.data.get_number_of_files():
-                stop_index = self.data.get_number_of_files()
+            stop_index = min(start_index + self.buffer_size, self.data.get_number_of_files())
+            # If there are no channels left to read then we are done
+            if stop_index <= start_index:
+                self.data.close()  # all channels have been read
+                raise StopIteration
             # Read the data from all current channels
+            num_samples = int(self.data.num_samples)
+            next_chunk = np.empty((stop_index - start_index, num_samples, self.num_bands), dtype=self.__dtype)
             for i in range(start_index, stop_index):
-                next_chunk.append(self.data.read_channel(i))  # Read a single HTK file with the data of one electrode
-            next_chunk_size = len(next_chunk)
-            # If didn't read any channels then return None, None
-            if next_chunk_size == 0:
-                raise StopIteration
-            # If we had data, then determine the chunk location and convert the data to numpy, and return
-            else:
-                self.current_fileindex = stop_index
-                next_chunk = np.asarray(next_chunk)
-                if self.time_axis_first:
-                    next_chunk = np.swapaxes(next_chunk, 0, 1)
+                # Read a single HTK file with the data of one electrode
+                if self.bands is None:
+                    next_chunk[i - start_index] = self.data.read_channel(i)
                 else:
-                    next_chunk_location = np.s_[start_index:stop_index, ...]
-
+                    next_chunk[i - start_index] = self.data.read_channel_range(i, 0, num_samples, bands=self.bands)
+            self.current_fileindex = stop_index
+            # Determine the chunk location and return
+            if self.time_axis_first:
+                next_chunk = np.swapaxes(next_chunk, 0, 1)
                 if self.__has_bands:
                     next_chunk_location = np.s_[:, start_index:stop_index, :]
                 else:
                     next_chunk_location = np.s_[:, start_index:stop_index]
                     next_chunk = next_chunk[:, :, 0]
-                # print(next_chunk.shape, next_chunk_location)
-                return DataChunk(next_chunk, next_chunk_location)
+            else:
+                next_chunk_location = np.s_[start_index:stop_index, 0:num_samples, 0:self.num_bands]
+            return DataChunk(next_chunk, next_chunk_location)
 
         @docval(returns='Tuple with the recommended chunk shape or None if no particular shape is recommended.')
         def recommended_chunk_shape(self):
-            """Recommend a chunk shape. This will typcially be the most common shape of chunk returned by __next__
-            but may also be some other value in case one wants to recommend chunk shapes to optimize read rather
-            than write."""
-            None
+            """Recommend a chunk shape. The chunks span the channels of one chunk returned by __next__,
+            so that each write covers whole HDF5 chunks, and as many samples as fit in about 1MB."""
+            num_bands = self.num_bands
+            num_samples = int(self.data.num_samples)
+            sample_bytes = self.buffer_size * num_bands * np.dtype(self.__dtype).itemsize
+            chunk_samples = int(min(num_samples, max(1, DEFAULT_CHUNK_BYTES // sample_bytes)))
+            if self.time_axis_first:
+                chunk_shape = (chunk_samples, self.buffer_size, num_bands)
+                if not self.__has_bands:
+                    chunk_shape = chunk_shape[0:2]
+            else:
+                chunk_shape = (self.buffer_size, chunk_samples, num_bands)
+            return chunk_shape
 
         def recommended_data_shape(self):
             """Recommend an initial shape of the data. This is useful when progressively writing data and
@@ -679,5 +822,126 @@ try:
                     return self.__maxshape
             return self.__first_chunk_shape
 
+    class HTKTimeIterator(AbstractDataChunkIterator):
+        """
+        Custom data chunk iterator to iterate over an HTK collection in windows of time.
+        Each chunk holds a window of consecutive samples from all channels, in (time, electrode, band)
+        order, so memory is bounded by the window rather than by the length of the recording,
+        and writes to a time-major dataset stay aligned with its chunks.
+        """
+        def __init__(self, data, has_bands=True, buffer_size=None, buffer_bytes=DEFAULT_BUFFER_BYTES,
+                     bands=None, native_byte_order=True, keep_files_open=True):
+            """
+            :param data: The HTKCollection to iterate over
+            :type data: HTKCollection
+            :param has_bands: If False, drop the band dimension (for collections with a single band)
+            :param buffer_size: Number of samples per chunk. Computed from buffer_bytes if None.
+            :param buffer_bytes: Target size in bytes of each chunk (default=64MB), used if buffer_size is None
+            :param bands: List of the indices of the bands to be read (see select_bands). Only the selected
+                          bands are converted and kept in memory. Set to None to read all bands (default=None)
+            :param native_byte_order: If False, the chunks of uncompressed collections keep the big-endian byte
+                          order of the HTK files, so the samples are copied from the files without byteswapping
+                          them and HDF5 converts them while writing (default=True)
+            :param keep_files_open: Every window reads all files in turn, so with more files than the
+                          max_open_files of the file pool of the collection, each file would be reopened for
+                          every window. If True, the limit of the pool is raised to the number of files while
+                          iterating, and restored when the iteration ends. This takes one file descriptor per
+                          file (two with use_memmap). Set to False to keep the limit of the pool (default=True)
+            """
+            super(HTKTimeIterator, self).__init__()
+            self.data = data
+            self.has_bands = has_bands
+            self.num_channels = self.data.get_number_of_files()
+            self.keep_files_open = keep_files_open
+            self.__max_open_files = None  # limit of the file pool while it is raised by the iteration
+            self.num_samples = int(self.data.num_samples)
+            self.bands = select_bands(int(self.data.num_bands), bands, has_bands)
+            self.num_bands = int(self.data.num_bands) if self.bands is None else len(self.bands)
+            self.__dtype = np.dtype(self.data.dtype)
+            compressed = self.data.parameter_kind & HTKFormat.param_kind_encoding['_C']
+            if not native_byte_order and self.bands is None and not compressed:
+                self.__dtype = self.__dtype.newbyteorder(HTKFormat.byte_order)
+            self.__maxshape = (self.num_samples, self.num_channels, self.num_bands)
+            if not self.has_bands:
+                self.__maxshape = self.__maxshape[0:2]
+            self.shape = self.__maxshape
+
+            # HDF5 chunks hold all channels and about 1MB; make the windows a multiple of them
+            row_bytes = max(1, self.num_channels * self.num_bands * self.__dtype.itemsize)
+            self.chunk_samples = int(max(1, min(self.num_samples, DEFAULT_CHUNK_BYTES // row_bytes)))
+            if buffer_size is None:
+                buffer_size = max(1, buffer_bytes // row_bytes)
+                buffer_size = max(self.chunk_samples, buffer_size // self.chunk_samples * self.chunk_samples)
+            self.buffer_size = int(buffer_size)
+            self.current_index = 0
+
+        @classmethod
+        def from_htk_collection(cls, collection, has_bands=True, buffer_size=None,
+                                buffer_bytes=DEFAULT_BUFFER_BYTES, bands=None, native_byte_order=True,
+                                keep_files_open=True):
+            """
+            Convenience function to generate a HTKTimeIterator from an existing HTKCollection
+            :param collection: The input HTKCollection for which we should create an iterator
+            :type collection: HTKCollection
+            :return: HTKTimeIterator for the input HTKCollection
+            """
+            return cls(data=collection, has_bands=has_bands, buffer_size=buffer_size,
+                       buffer_bytes=buffer_bytes, bands=bands, native_byte_order=native_byte_order,
+                       keep_files_open=keep_files_open)
+
+        @property
+        def maxshape(self):
+            return self.__maxshape
+
+        @property
+        def dtype(self):
+            return self.__dtype
+
+        def __iter__(self):
+            """Return the iterator object"""
+            return self
+
+        def __next__(self):
+            """Return the next data chunk or raise a StopIteration exception if all chunks have been retrieved."""
+            start_index = self.current_index
+            stop_index = min(start_index + self.buffer_size, self.num_samples)
+            if stop_index <= start_index:
+                self.data.close()  # all samples have been read
+                if self.__max_open_files is not None:
+                    self.data.file_pool.max_open_files = self.__max_open_files
+                    self.__max_open_files = None
+                raise StopIteration
+            file_pool = self.data.file_pool
+            if self.keep_files_open and self.__max_open_files is None and file_pool.max_open_files < self.num_channels:
+                logger.info('Keeping all %i HTK files of %s open while iterating over time (max_open_files=%i)'
+                            % (self.num_channels, self.data.directory, file_pool.max_open_files))
+                self.__max_open_files = file_pool.max_open_files
+                file_pool.max_open_files = self.num_channels
+            # Read the window from each channel (a bounded read per file), directly into the chunk
+            next_chunk = np.empty((stop_index - start_index, self.num_channels, self.num_bands),
+                                  dtype=self.__dtype)
+            for fileindex in range(self.num_channels):
+                if self.bands is None:
+                    self.data.read_channel_range(fileindex, start_index, stop_index,
+                                                 out=next_chunk[:, fileindex, :])
+                else:
+                    next_chunk[:, fileindex, :] = self.data.read_channel_range(fileindex, start_index, stop_index,
+                                                                               bands=self.bands)
+            self.current_index = stop_index
+            if not self.has_bands:
+                next_chunk = next_chunk[:, :, 0]
+            # explicit slices; hdmf cannot compute the bounds of an Ellipsis selection
+            selection = (slice(start_index, stop_index),) + tuple(slice(0, n) for n in self.__maxshape[1:])
+            return DataChunk(next_chunk, selection)
+
+        def recommended_chunk_shape(self):
+            """Recommend a chunk shape: all channels, and as many samples as fit in about 1MB."""
+            return (self.chunk_samples,) + self.__maxshape[1:]
+
+        def recommended_data_shape(self):
+            """Recommend an initial shape of the data: the full shape of the collection."""
+            return self.__maxshape
+
 except ImportError:
-    warnings.warn("Could not import hdmf.utils.DataChunkIterator. HTKChannelIterator not available")
+    warnings.warn("Could not import hdmf.utils.DataChunkIterator. HTKChannelIterator and HTKTimeIterator "
+                  "not available")
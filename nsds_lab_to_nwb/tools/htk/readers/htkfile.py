@@ -1,4 +1,7 @@
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from struct import unpack
+import threading
 import numpy as np
 import sys
 
@@ -142,11 +145,75 @@ class HTKFormat(object):
             hf += he['format']
         return hf
 
+    @classmethod
+    def header_dtype(cls):
+        """
+        Get the numpy structured dtype of the HTK file header.
+
+        :returns: numpy dtype with one big-endian field per header entry, e.g., to read many headers at once.
+
+        """
+        return np.dtype([(he['name'], cls.byte_order + he['format']) for he in cls.header])
+
+
+def read_headers(filenames, workers=1):
+    """
+    Read the raw header of many HTK files into a structured numpy array, without parsing the files any further.
+
+    :param filenames: List of HTK file names
+    :param workers: Number of threads reading headers concurrently (default=1)
+
+    :returns: 1D numpy array of dtype HTKFormat.header_dtype() with one element per file
+
+    :raises: ValueError is raised if a file is too short to contain a header.
+    """
+    header_dtype = HTKFormat.header_dtype()
+    headers = np.empty(len(filenames), dtype=header_dtype)
+
+    def read_header(fileindex):
+        with open(filenames[fileindex], 'rb') as f:
+            raw = f.read(header_dtype.itemsize)
+        if len(raw) != header_dtype.itemsize:
+            raise ValueError('Incomplete HTK header in %s' % filenames[fileindex])
+        headers[fileindex] = np.frombuffer(raw, dtype=header_dtype)[0]
+
+    if workers > 1:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(read_header, range(len(filenames))))
+    else:
+        for fileindex in range(len(filenames)):
+            read_header(fileindex)
+    return headers
+
+
+def header_mismatches(headers):
+    """
+    Compare the headers of HTK files to the header of the first file.
+
+    :param headers: Structured numpy array of headers, as returned by read_headers
+
+    :returns: Dict with, for each header field that is not the same in all files, a numpy
+              array of the indices of the files whose value differs from the first file.
+              An empty dict means that all headers are the same.
+    """
+    mismatches = {}
+    if len(headers) == 0:
+        return mismatches
+    for name in headers.dtype.names:
+        fileindices = np.flatnonzero(headers[name] != headers[name][0])
+        if len(fileindices) > 0:
+            mismatches[name] = fileindices
+    return mismatches
+
 
 class HTKFile(object):
     """
     Class used for reading HTK format files.
 
+    The file stays open for reading until close() is called. HTKFile can be used as
+    a context manager to close the file on exit, e.g.,
+    ``with HTKFile(filename) as htk_file: data = htk_file.read_data()``.
+
     NOTE: The original HTK specification specifies that the sample_period is given in the header in 100ns
     units. In some cases however, users appear to write the sampling rate in the header with a different
     base. We therefore allow users to specify the base for the sampling rate and if given we assume that
@@ -169,13 +236,27 @@ class HTKFile(object):
 
     Internal Variables:
 
+    :ivar use_memmap: Read the data through a memory map of the file (see memmap())
     :ivar __file: The handle to the HTK file
+    :ivar __memmap: Memory map of the samples in the file, or None if not created yet
     :ivar __current_pos: Internal variable used to store the current sample position during iteration
+    :ivar __current_block: Internal variable used to store the block of samples read during iteration
 
     """
+    iter_block_size = 4096
+    """
+    Number of samples read at once when iterating over the samples of the file.
+    """
+
+    decompress_chunk_bytes = 2 ** 20
+    """
+    Number of bytes of float32 output uncompressed at once (see decompress).
+    """
+
     def __init__(self,
                  filename,
-                 sample_rate_base=10000.):
+                 sample_rate_base=10000.,
+                 use_memmap=False):
         """
         Initialize the htk file
 
@@ -183,14 +264,19 @@ class HTKFile(object):
         :param sample_rate_base: None if the sample_period is given in the header. Set to the number that
             should we should divide the sampling rate given in the header by in order to convert the
             rate to the appropriate value in Hz.
+        :param use_memmap: Read data through a memory map of the file, so that only the pages with the
+            requested samples are read and the data is copied only once, when converted to native byte order.
 
         :return:
         """
         self.filename = filename
+        self.use_memmap = use_memmap
         self.__file = open(self.filename, 'rb')
+        self.__memmap = None
 
         self.data = None  # Numpy array with all data or None
         self.__current_pos = 0  # Current sample position. This variable is used during iteration.
+        self.__current_block = None  # Tuple of the start index and data of the block of samples being iterated
 
         # Read the HTK header to initialize the variables: self.num_samples,
         # self.sample_period, self.sample_size, self.parameter_kind
@@ -217,33 +303,76 @@ class HTKFile(object):
         # Get the coefficients for compressed data
         if self.parameter_kind & HTKFormat.param_kind_encoding['_C']:
             self.dtype = 'h'
-            self.vector_length = self.sample_size / 2
+            self.vector_length = self.sample_size // 2
             if self.parameter_kind & 0x3f == HTKFormat.param_kind_base['IREFC']:
-                self.A = 32767
-                self.B = 0
+                self.A = np.full(self.vector_length, 32767, dtype='f')
+                self.B = np.zeros(self.vector_length, dtype='f')
             else:
                 self.A = np.fromfile(self.__file, 'f', self.vector_length)
                 self.B = np.fromfile(self.__file, 'f', self.vector_length)
                 if self.__swap_required():
                     self.A = self.A.byteswap()
                     self.B = self.B.byteswap()
+                # The A and B vectors take the space of 4 compressed samples, which are included in the count
+                self.num_samples -= 4
         else:
             self.dtype = 'f'
-            self.vector_length = self.sample_size / 4
+            self.vector_length = self.sample_size // 4
         self.header_length = self.__file.tell()
 
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """
+        Close the handle to the HTK file. The header information remains available,
+        but no more data can be read from the file.
+        """
+        self.__file.close()
+        self.__memmap = None
+
+    @property
+    def compressed(self):
+        """
+        Boolean indicating whether the data in the file is compressed (_C parameter kind).
+        """
+        return bool(self.parameter_kind & HTKFormat.param_kind_encoding['_C'])
+
+    @property
+    def closed(self):
+        """
+        Boolean indicating whether the handle to the HTK file has been closed.
+        """
+        return self.__file.closed
+
+    def clear_data(self):
+        """
+        Clear the self.data instance variable to free up memory.
+        """
+        self.data = None
+
     def __iter__(self):
         """Make the HTKFile iterable"""
-        self.__seek_sample(0)
         self.__current_pos = 0
+        self.__current_block = None
         return self
 
     def __next__(self):
         """Get the next item for iteration"""
+        if self.__current_pos >= self.num_samples:
+            raise StopIteration
         if self.data is not None:
             d = self.data[self.__current_pos, :]
         else:
-            d = self.read_sample(sample_index=self.__current_pos)
+            # Read the samples in blocks instead of one sample at a time
+            block_start = self.__current_pos - self.__current_pos % self.iter_block_size
+            if self.__current_block is None or self.__current_block[0] != block_start:
+                self.__current_block = (block_start,
+                                        self.read_range(block_start, block_start + self.iter_block_size))
+            d = self.__current_block[1][self.__current_pos - block_start]
         self.__current_pos += 1
         return d
 
@@ -290,17 +419,153 @@ class HTKFile(object):
             return self.data[sample_index, :]
         # If the data has not been read yet, then read it from file
         else:
-            # Put the file handler at the position of the sample
-            self.__seek_sample(sample_index)
-            # Read the data for the sample
-            tempvec = np.fromfile(self.__file, self.dtype, int(self.vector_length))
-            # Perform byteswap if necessary
+            return self.read_range(sample_index, sample_index + 1)[0]
+
+    def memmap(self):
+        """
+        Memory-map the samples in the file (after the header, without the checksum).
+
+        :returns: Read-only numpy memmap of shape (#samples, #vector_length) with the big-endian dtype
+            of the file ('>f4', or '>i2' for compressed data). Nothing is read from disk until the memmap is
+            accessed, and slicing it reads only the pages of the selected samples.
+            Use to_native() to convert the data to native byte order (and uncompress it).
+        """
+        if self.__memmap is None:
+            self.__memmap = np.memmap(self.filename, dtype=np.dtype(self.dtype).newbyteorder('>'), mode='r',
+                                      offset=self.header_length,
+                                      shape=(self.num_samples, self.vector_length))
+        return self.__memmap
+
+    def to_native(self, rawdata, bands=None):
+        """
+        Convert raw big-endian data, e.g., a slice of memmap(), to a native-order numpy array,
+        and uncompress it to floats if needed. This copies the data once.
+
+        :param rawdata: Numpy array with the big-endian dtype of the file
+        :param bands: Selection of the vector elements (e.g., frequency bands) in rawdata, if it does not
+                      hold all of them. Used to select the compression parameters (default=None)
+
+        :returns: Numpy data array in native byte order
+        """
+        if self.parameter_kind & HTKFormat.param_kind_encoding['_C']:
+            return self.decompress(rawdata, bands=bands)
+        return rawdata.astype(rawdata.dtype.newbyteorder('='))
+
+    def decompress(self, rawdata, out=None, bands=None):
+        """
+        Uncompress compressed (_C) data to floats, (rawdata + B) / A, in chunks of samples
+        written in place into the output, so that no full-size temporary arrays are created.
+
+        :param rawdata: Numpy int16 array of shape (#samples, #vector_length), in any byte order,
+                        e.g., a slice of memmap()
+        :param out: Optional preallocated float32 numpy array of the same shape to write to
+        :param bands: Selection of the vector elements (e.g., frequency bands) in rawdata, if it does not
+                      hold all of them (default=None)
+
+        :returns: out, or a new float32 numpy array if out is None
+        """
+        A, B = (self.A, self.B) if bands is None else (self.A[bands], self.B[bands])
+        if out is None:
+            out = np.empty(rawdata.shape, dtype='f')
+        chunk_samples = max(1, self.decompress_chunk_bytes // (4 * self.vector_length))
+        for start in range(0, len(rawdata), chunk_samples):
+            chunk = out[start:start + chunk_samples]
+            np.add(rawdata[start:start + chunk_samples], B, out=chunk, casting='unsafe')
+            chunk /= A
+        return out
+
+    def read_range(self, start, stop, bands=None):
+        """
+        Read the data of the samples in the range [start, stop) with a single bounded read,
+        without reading the rest of the file (see read_into).
+
+        :param start: Index of the first sample to be read
+        :param stop: Index one past the last sample to be read. Clipped to num_samples.
+        :param bands: Optional list (or slice) of the vector elements, e.g., frequency bands, to be read.
+                      Only the selected elements are copied, converted and uncompressed (default=None)
+
+        :returns: Numpy data array of shape (#samples, #vector_length), or (#samples, #bands)
+        """
+        # If we have read all data then return the data directly
+        if self.data is not None:
+            return self.data[start:stop] if bands is None else self.data[start:stop, bands]
+        start = min(max(0, start), self.num_samples)
+        stop = min(max(start, stop), self.num_samples)
+        if bands is not None:
+            # select the bands from the memory map, before converting them
+            return self.to_native(self.memmap()[start:stop, bands], bands=bands)
+        # Compressed data is uncompressed to floats
+        out = np.empty((stop - start, self.vector_length), dtype='f')
+        return self.read_into(out, start=start)
+
+    def __getitem__(self, key):
+        """
+        Read samples by index or slice, e.g., htk_file[1000:2000] or htk_file[1000:2000, 0],
+        reading only the range of samples that is selected (see read_range).
+
+        :param key: Integer or slice along the samples, optionally followed by a selection of the vector elements
+        """
+        if isinstance(key, tuple):
+            sample_key, vector_key = key[0], key[1:]
+        else:
+            sample_key, vector_key = key, ()
+        if isinstance(sample_key, slice):
+            indices = range(*sample_key.indices(self.num_samples))
+            if len(indices) == 0:
+                data = self.read_range(0, 0)
+            else:
+                # read the bounding range of the slice once and select from it
+                first = min(indices[0], indices[-1])
+                data = self.read_range(first, max(indices[0], indices[-1]) + 1)[indices[0] - first::indices.step]
+        else:
+            sample_index = int(sample_key)
+            if sample_index < 0:
+                sample_index += self.num_samples
+            if not 0 <= sample_index < self.num_samples:
+                raise IndexError('Sample index %i out of range for %i samples' % (sample_key, self.num_samples))
+            data = self.read_range(sample_index, sample_index + 1)[0]
+        if vector_key:
+            data = data[(slice(None),) * (data.ndim - 1) + vector_key]
+        return data
+
+    def read_into(self, out, start=0):
+        """
+        Read the data of consecutive samples directly into a preallocated array, without temporary copies.
+        Uncompressed data is read from the file straight into the memory of out and byteswapped in place,
+        or copied from the memory map with use_memmap (or if out is not a C-contiguous array of the file dtype).
+
+        :param out: C-contiguous numpy array of shape (#samples, #vector_length) to fill, e.g., a slice of a
+            larger buffer. The number of samples read is given by the length of out.
+        :param start: Index of the first sample to be read
+
+        :returns: out
+        """
+        stop = start + out.shape[0]
+        if out.shape[1:] != (self.vector_length,) or start < 0 or stop > self.num_samples:
+            raise ValueError('Cannot read samples %i to %i into an array of shape %s'
+                             % (start, stop, str(out.shape)))
+        if out.size == 0:
+            return out
+        if self.data is not None:
+            out[...] = self.data[start:stop]
+        elif self.parameter_kind & HTKFormat.param_kind_encoding['_C']:
+            # uncompress from the memory map, without a full temporary array
+            self.decompress(self.memmap()[start:stop], out=out)
+        elif self.use_memmap or out.dtype != np.dtype(self.dtype) or not out.flags['C_CONTIGUOUS']:
+            # numpy converts the byte order (and dtype) while copying
+            out[...] = self.memmap()[start:stop]
+        else:
+            self.__seek_sample(start)
+            buffer = memoryview(out).cast('B')
+            num_read = 0
+            while num_read < len(buffer):
+                num_bytes = self.__file.readinto(buffer[num_read:])
+                if not num_bytes:
+                    raise IOError('Unexpected end of file in %s' % self.filename)
+                num_read += num_bytes
             if self.__swap_required():
-                tempvec = tempvec.byteswap()
-            # Uncompress data to floats if needed
-            if self.parameter_kind & HTKFormat.param_kind_encoding['_C']:
-                tempvec = (tempvec.astype('f') + self.B) / self.A
-            return tempvec
+                out.byteswap(inplace=True)
+        return out
 
     def read_data(self):
         """
@@ -308,20 +573,73 @@ class HTKFile(object):
 
         :returns: Numpy data array of all the samples
         """
-        # Jump to the beginning of the file
-        self.__seek_sample(0)
-        # Read all data
-        tempdata = np.fromfile(self.__file, self.dtype)
-        # Remove the checksum data
-        if self.parameter_kind & HTKFormat.param_kind_encoding['_K']:
-            tempdata = tempdata[:-1]
-        # Reshape the data to (#vectors, #vector_length
-        outshape = (int(len(tempdata) / self.vector_length), int(self.vector_length))
-        tempdata = tempdata.reshape(outshape)
-        if self.__swap_required():
-            tempdata = tempdata.byteswap()
-        # Uncompress data to floats if needed
-        if self.parameter_kind & HTKFormat.param_kind_encoding['_C']:
-            tempdata = (tempdata.astype('f') + self.B) / self.A
-        self.data = tempdata
+        self.data = self.read_range(0, self.num_samples)
         return self.data
+
+
+class HTKFilePool(object):
+    """
+    Bounded pool of open HTKFile objects, shared by the readers of a collection of HTK files.
+
+    At most max_open_files files are kept open; the least recently used file is closed
+    when another one needs to be opened. This keeps the number of open file descriptors
+    bounded for large collections, while files that are read repeatedly (e.g., once per
+    chunk) are opened (and their header parsed) only once.
+
+    The pool can be used as a context manager to close all files on exit.
+
+    :ivar max_open_files: Maximum number of files kept open at the same time
+    :ivar sample_rate_base: sample_rate_base passed to HTKFile
+    :ivar use_memmap: use_memmap passed to HTKFile
+    """
+    def __init__(self, max_open_files=64, sample_rate_base=10000., use_memmap=False):
+        """
+        :param max_open_files: Maximum number of files kept open at the same time.
+        :param sample_rate_base: See HTKFile.
+        :param use_memmap: See HTKFile.
+        """
+        if max_open_files < 1:
+            raise ValueError('max_open_files must be at least 1')
+        self.max_open_files = max_open_files
+        self.sample_rate_base = sample_rate_base
+        self.use_memmap = use_memmap
+        self.__files = OrderedDict()
+        self.__lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __len__(self):
+        return len(self.__files)
+
+    def get(self, filename):
+        """
+        Get the open HTKFile for the given filename, opening it if needed.
+
+        :param filename: The name of the htk file
+
+        :returns: HTKFile object. Do not close it; it is closed by the pool.
+        """
+        with self.__lock:
+            htk_file = self.__files.pop(filename, None)
+            if htk_file is None:
+                htk_file = HTKFile(filename, sample_rate_base=self.sample_rate_base,
+                                   use_memmap=self.use_memmap)
+                while len(self.__files) >= self.max_open_files:
+                    _, oldest_file = self.__files.popitem(last=False)
+                    oldest_file.close()
+            # (re-)insert as the most recently used file
+            self.__files[filename] = htk_file
+            return htk_file
+
+    def close(self):
+        """
+        Close all open files in the pool.
+        """
+        with self.__lock:
+            while self.__files:
+                _, htk_file = self.__files.popitem()
+                htk_file.close()
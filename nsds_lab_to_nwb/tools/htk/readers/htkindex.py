@@ -0,0 +1,176 @@
+import logging
+import os
+import threading
+
+import numpy as np
+
+from nsds_lab_to_nwb.tools.cache import keyed_cache_path, save_npz
+
+from .htkfile import HTKFormat, read_headers
+
+"""
+Module used for indexing directories of HTK files, so that the files of a directory are listed
+and their headers are read once, and shared by all HTKCollections of the directory.
+"""
+
+logger = logging.getLogger(__name__)
+
+
+class HTKDirectoryIndex(object):
+    """
+    Index of the HTK files in a directory: names, sizes, the digits at the end of the names
+    (which encode the block and channel index) and the raw headers of the files.
+
+    Use get_directory_index() to get the index of a directory, which shares one index per
+    directory in memory and (optionally) caches it on disk.
+
+    :ivar directory: Absolute path to the directory
+    :ivar mtime_ns: Modification time of the directory when the index was built, in ns
+    :ivar filenames: 1D numpy array of the HTK file names (without the directory), in sorted order
+    :ivar sizes: 1D numpy array of the file sizes in bytes
+    :ivar index_digits: 1D numpy array of the digits at the end of the file names (see block_channel_index)
+    :ivar headers: 1D structured numpy array with the header of each file (see htkfile.read_headers)
+    """
+    def __init__(self, directory, mtime_ns, filenames, sizes, index_digits, headers):
+        self.directory = directory
+        self.mtime_ns = mtime_ns
+        self.filenames = filenames
+        self.sizes = sizes
+        self.index_digits = index_digits
+        self.headers = headers
+
+    def __len__(self):
+        return len(self.filenames)
+
+    @property
+    def paths(self):
+        """
+        List of the full paths of the HTK files
+        """
+        return [os.path.join(self.directory, filename) for filename in self.filenames]
+
+    @classmethod
+    def build(cls, directory, workers=1):
+        """
+        List the HTK files of a directory and read their headers.
+
+        :param directory: Directory with the HTK files
+        :param workers: Number of threads reading headers concurrently (default=1)
+        """
+        directory = os.path.abspath(directory)
+        mtime_ns = os.stat(directory).st_mtime_ns
+        with os.scandir(directory) as entries:
+            files = sorted((entry.name, entry.stat().st_size) for entry in entries
+                           if entry.name.endswith('.htk') and entry.is_file())
+        filenames = np.array([name for name, _ in files], dtype=str)
+        sizes = np.array([size for _, size in files], dtype='int64')
+        index_digits = np.array([cls.__get_index_digits(name) for name in filenames], dtype=str)
+        headers = read_headers([os.path.join(directory, name) for name in filenames], workers=workers)
+        return cls(directory, mtime_ns, filenames, sizes, index_digits, headers)
+
+    @staticmethod
+    def __get_index_digits(filename):
+        """
+        Get all digits at the end of the name of a HTK file (before the .htk extension).
+        """
+        basename = filename.rstrip('.htk')
+        num_digits = len(basename) - len(basename.rstrip('0123456789'))
+        return basename[len(basename) - num_digits:]
+
+    def block_channel_index(self, noblock=False, selection=None):
+        """
+        Get the block index and channel index of files, based on the digits at the end
+        of the file names. Indices are 1-based as in the file names.
+
+        :param noblock: Boolean to indicate that no block index is given in the filenames (default=False).
+                        Otherwise the first digit is the block index and the remaining digits the channel index.
+        :param selection: Indices of the files in the index to get the block and channel index of.
+                          Set to None to get them for all files (default=None)
+
+        :returns: 1D numpy arrays of the block index and of the channel index of each file
+        """
+        index_digits = self.index_digits if selection is None else self.index_digits[selection]
+        if noblock:
+            channelindex = np.array([int(digits) for digits in index_digits], dtype=int)
+            blockindex = np.ones(len(channelindex), dtype=int)
+        else:
+            blockindex = np.array([int(digits[0]) for digits in index_digits], dtype=int)
+            channelindex = np.array([int(digits[1:]) for digits in index_digits], dtype=int)
+        return blockindex, channelindex
+
+    def save(self, path):
+        """
+        Save the index to a .npz file (see nsds_lab_to_nwb.tools.cache.save_npz).
+        """
+        save_npz(path, directory=np.array(self.directory), mtime_ns=np.array(self.mtime_ns),
+                 filenames=self.filenames, sizes=self.sizes, index_digits=self.index_digits,
+                 headers=self.headers)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Load an index saved with save().
+        """
+        with np.load(path) as cached:
+            return cls(directory=str(cached['directory']),
+                       mtime_ns=int(cached['mtime_ns']),
+                       filenames=cached['filenames'],
+                       sizes=cached['sizes'],
+                       index_digits=cached['index_digits'],
+                       headers=cached['headers'].astype(HTKFormat.header_dtype()))
+
+
+def get_cache_path(directory, mtime_ns, cache_dir):
+    """
+    Get the path of the cached index of a HTK directory. The file name is keyed by the path and
+    modification time of the directory, which changes when files are added, removed or renamed.
+
+    :param directory: Absolute path to the directory with the HTK files
+    :param mtime_ns: Modification time of the directory in ns
+    :param cache_dir: Directory of the cache files
+    """
+    dirname = os.path.basename(os.path.normpath(directory))
+    return keyed_cache_path(cache_dir, 'htk_%s' % dirname, directory, mtime_ns)
+
+
+_shared_indices = {}
+_shared_indices_lock = threading.Lock()
+
+
+def get_directory_index(directory, cache_dir=None, workers=1):
+    """
+    Get the index of a directory of HTK files. The index is built once per directory and shared in
+    memory (e.g., by the HTKCollections of all devices recorded in the directory) as long as the
+    modification time of the directory does not change.
+
+    NOTE: Files that are rewritten in place do not change the modification time of the directory.
+
+    :param directory: Directory with the HTK files
+    :param cache_dir: Directory to keep the index in, as one .npz file per HTK directory,
+                      so that it is reused across runs. Set to None to not cache the index on disk (default=None)
+    :param workers: Number of threads reading headers concurrently when building the index (default=1)
+
+    :returns: HTKDirectoryIndex
+    """
+    directory = os.path.abspath(directory)
+    mtime_ns = os.stat(directory).st_mtime_ns
+    with _shared_indices_lock:
+        index = _shared_indices.get(directory)
+        if index is not None and index.mtime_ns == mtime_ns:
+            return index
+
+        cache_path = None if cache_dir is None else get_cache_path(directory, mtime_ns, cache_dir)
+        if cache_path is not None and os.path.exists(cache_path):
+            logger.debug('Loading cached HTK directory index from %s' % cache_path)
+            index = HTKDirectoryIndex.load(cache_path)
+        else:
+            index = HTKDirectoryIndex.build(directory, workers=workers)
+            if index.mtime_ns != mtime_ns:
+                # the directory changed while it was listed
+                cache_path = None
+            if cache_path is not None:
+                os.makedirs(cache_dir, exist_ok=True)
+                index.save(cache_path)
+                logger.debug('Cached HTK directory index to %s' % cache_path)
+        _shared_indices[directory] = index
+        return index
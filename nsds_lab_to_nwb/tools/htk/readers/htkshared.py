@@ -0,0 +1,126 @@
+import weakref
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+
+"""
+Module used for sharing the data of HTK collections with other processes through shared memory.
+"""
+
+
+class SharedHTKData(object):
+    """
+    Descriptor of the data of a HTKCollection in a shared memory segment (see HTKCollection.read_data).
+
+    The descriptor only holds the name of the segment and the shape and dtype of the data, so it is cheap
+    to pickle and send to worker processes, which call attach() to get a numpy view of the data without
+    copying it. The process that created the segment calls unlink() (e.g., via
+    HTKCollection.unlink_shared_data) once no other process needs to attach to it anymore.
+    The memory stays mapped as long as any array returned by attach() is in use.
+
+    :ivar name: Name of the shared memory segment
+    :ivar shape: Shape of the data, (#channels, #samples, #bands) as in HTKCollection.shape
+    :ivar dtype: Numpy dtype of the data
+    :ivar sample_rate: Sampling rate of the data in Hz, or None
+    """
+    def __init__(self, name, shape, dtype, sample_rate=None):
+        self.name = name
+        self.shape = tuple(int(n) for n in shape)
+        self.dtype = np.dtype(dtype)
+        self.sample_rate = sample_rate
+        self.__shm = None
+        self.__views = []    # weak references to the arrays returned by attach()
+
+    @classmethod
+    def create(cls, shape, dtype, sample_rate=None):
+        """
+        Create a new shared memory segment for data of the given shape and dtype.
+
+        :returns: SharedHTKData for the new segment, attached in the current process
+        """
+        nbytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+        shm = shared_memory.SharedMemory(create=True, size=max(1, nbytes))
+        descriptor = cls(shm.name, shape, dtype, sample_rate=sample_rate)
+        descriptor.__shm = shm
+        return descriptor
+
+    def __getstate__(self):
+        # the handle to the segment is not sent to other processes, they attach by name
+        state = self.__dict__.copy()
+        del state['_SharedHTKData__shm'], state['_SharedHTKData__views']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.__shm = None
+        self.__views = []
+
+    def attach(self):
+        """
+        Get a numpy view of the shared data, attaching to the segment if needed. No data is copied.
+
+        :returns: Numpy array of shape self.shape backed by the shared memory segment
+        """
+        if self.__shm is None:
+            self.__shm = self.__attach_segment(self.name)
+        view = np.ndarray(self.shape, dtype=self.dtype, buffer=self.__shm.buf)
+        # views of the array keep it alive, so the array tells when the memory is no longer used
+        self.__views = [ref for ref in self.__views if ref() is not None] + [weakref.ref(view)]
+        return view
+
+    @staticmethod
+    def __attach_segment(name):
+        """
+        Attach to an existing segment, without letting the resource tracker of this process unlink it
+        when the process exits (the segment belongs to the process that created it).
+        """
+        try:
+            return shared_memory.SharedMemory(name=name, track=False)
+        except TypeError:
+            # Python < 3.13 always registers the segment
+            shm = shared_memory.SharedMemory(name=name)
+            resource_tracker.unregister(shm._name, 'shared_memory')
+            return shm
+
+    def close(self):
+        """
+        Close the handle to the segment in this process. The memory is unmapped once all arrays
+        returned by attach() (and their views) have been deleted, so they remain valid until then.
+        """
+        if self.__shm is not None:
+            views = [ref() for ref in self.__views]
+            self.__close_when_unused(self.__shm, [view for view in views if view is not None])
+            del views
+            self.__shm = None
+            self.__views = []
+
+    @staticmethod
+    def __close_when_unused(shm, views):
+        """
+        Close shm once all views are garbage collected. The finalizers keep shm alive until then.
+        """
+        if not views:
+            shm.close()
+            return
+        num_views = [len(views)]
+
+        def release():
+            num_views[0] -= 1
+            if num_views[0] == 0:
+                shm.close()
+        for view in views:
+            weakref.finalize(view, release)
+
+    def unlink(self):
+        """
+        Destroy the segment, so that no process can attach to it anymore, and close the handle (see close()).
+        Arrays that are still in use keep the memory mapped. Call only from the process that created the segment.
+        """
+        if self.__shm is None:
+            shm = self.__attach_segment(self.name)
+            resource_tracker.register(shm._name, 'shared_memory')
+            shm.unlink()
+            shm.close()
+        else:
+            self.__shm.unlink()
+        self.close()
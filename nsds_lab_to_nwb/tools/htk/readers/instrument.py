@@ -1,5 +1,5 @@
 import numpy as np
-from .htkcollection import HTKCollection, HTKChannelIterator
+from .htkcollection import HTKCollection, HTKChannelIterator, HTKTimeIterator
 # try:
 #    from scipy.misc import imread
 # except ImportError:
@@ -104,7 +104,8 @@ class EPhysInstrumentData:
         if read_on_create:
             self.read_data()
 
-    def read_data(self, create_iterator=False, print_status=False, time_axis_first=True, has_bands=True):
+    def read_data(self, create_iterator=False, print_status=False, time_axis_first=True, has_bands=True,
+                  iterate_over_time=False, workers=1, bands=None, native_byte_order=True):
         """
         Read the data for all channels
 
@@ -116,6 +117,15 @@ class EPhysInstrumentData:
         :param print_status: One of [True, False, 'jupyter']. True means-Print status message on
                         read progress on screen. 'jupyter' means create a progress bar in a Jupyter notebook.
                         False means, don't show process. Default is False.
+        :param iterate_over_time: If set to True (along with create_iterator and time_axis_first), create a
+                         HTKTimeIterator that reads windows of time from all channels, instead of
+                         a HTKChannelIterator that reads whole channels
+        :param workers: Number of threads reading channels concurrently when reading all data
+                         (see HTKCollection.read_data)
+        :param bands: List of the indices of the bands to keep, or None to keep all bands. The iterators
+                         read only the selected bands (see htkcollection.select_bands)
+        :param native_byte_order: If False, a HTKTimeIterator keeps the big-endian byte order of uncompressed
+                         HTK files in its chunks, so that the samples are not byteswapped (see HTKTimeIterator)
 
         :return:
         """
@@ -124,17 +134,30 @@ class EPhysInstrumentData:
                                    prefix=self.prefix,
                                    layout=self.layout,
                                    **self.htkcollection_kwargs)
-        if create_iterator:
+        if create_iterator and iterate_over_time:
+            if not time_axis_first:
+                raise ValueError('iterate_over_time requires time_axis_first')
+            self.data = HTKTimeIterator.from_htk_collection(collection=collection,
+                                                            has_bands=has_bands,
+                                                            bands=bands,
+                                                            native_byte_order=native_byte_order)
+        elif create_iterator:
             # from mars.io.readers.htkcollection import HTKChannelIterator
             self.data = HTKChannelIterator.from_htk_collection(collection=collection,
                                                                time_axis_first=time_axis_first,
-                                                               has_bands=has_bands)
+                                                               has_bands=has_bands,
+                                                               bands=bands)
         else:
-            self.data = collection.read_data(print_status=print_status)
+            self.data = collection.read_data(print_status=print_status, workers=workers)
+            collection.close()
+            if bands is not None:
+                self.data = self.data[..., bands]
             if time_axis_first:
                 self.data = np.swapaxes(self.data, 0, 1)
         self.sample_rate = collection.sample_rate
         self.bands = collection.bands
+        if self.bands is not None and bands is not None:
+            self.bands = np.asarray(self.bands)[bands]
         if self.device_image_name is not None:
             self.device_image = imread(self.device_image_name)
 
@@ -0,0 +1,73 @@
+import logging.config
+
+import numpy as np
+from hdmf.data_utils import AbstractDataChunkIterator, DataChunk
+
+logger = logging.getLogger(__name__)
+
+
+DEFAULT_BUFFER_SIZE = 2**20
+
+
+class StreamIterator(AbstractDataChunkIterator):
+    """Iterate over a (time, channel) stream in blocks of consecutive samples.
+
+    Each chunk is a contiguous, time-major array in native byte order. For a transposed view
+    of a decoded (channel, time) TDT stream, the transpose is done one block at a time, so writing
+    the stream never needs a second full copy of it.
+
+    Parameters
+    ----------
+    data: array-like
+        Stream data of shape (time, channel), or (time,) for a single channel, e.g. a SEVStream,
+        the transpose of a decoded TDT stream, or a big-endian memory map of an HTK file.
+        Must support slicing along time, and have shape and dtype attributes.
+    buffer_size: int
+        Number of samples (of all channels) per chunk.
+    columns: list, optional
+        Indices of the channels (columns of data) to write, in order. The channels are picked
+        from each block, so reordering them never copies the whole stream.
+        Defaults to None (all channels, as stored).
+    """
+    def __init__(self, data, buffer_size=DEFAULT_BUFFER_SIZE, columns=None):
+        self.data = data
+        self.buffer_size = int(buffer_size)
+        self.columns = None if columns is None else list(columns)
+        self.current_index = 0
+
+    @property
+    def dtype(self):
+        return np.dtype(self.data.dtype).newbyteorder('=')
+
+    @property
+    def maxshape(self):
+        if self.columns is None:
+            return tuple(self.data.shape)
+        return (self.data.shape[0], len(self.columns)) + tuple(self.data.shape[2:])
+
+    def __iter__(self):
+        """Return the iterator object"""
+        return self
+
+    def __next__(self):
+        """Return the next data chunk or raise a StopIteration exception if all chunks have been retrieved."""
+        start_index = self.current_index
+        stop_index = min(start_index + self.buffer_size, self.data.shape[0])
+        if start_index >= stop_index:
+            raise StopIteration
+        self.current_index = stop_index
+        next_chunk = self.data[start_index:stop_index]
+        if self.columns is not None:
+            next_chunk = next_chunk[:, self.columns]
+        next_chunk = np.ascontiguousarray(next_chunk, dtype=self.dtype)
+        # explicit slices; hdmf cannot compute the bounds of an Ellipsis selection
+        selection = (slice(start_index, stop_index),) + tuple(slice(0, n) for n in self.maxshape[1:])
+        return DataChunk(next_chunk, selection)
+
+    def recommended_chunk_shape(self):
+        """Recommend a chunk shape. None lets h5py choose."""
+        return None
+
+    def recommended_data_shape(self):
+        """Recommend an initial shape of the data: the full stream."""
+        return self.maxshape
@@ -0,0 +1,142 @@
+import logging.config
+import os
+
+import numpy as np
+import tdt
+
+from nsds_lab_to_nwb.tools.tdt.sev_reader import find_sev_files
+from nsds_lab_to_nwb.tools.tdt.tdt_reader import stream_alternatives
+
+logger = logging.getLogger(__name__)
+
+
+TSQ_RECORD_SIZE = 40    # bytes per TSQ event record
+EVENT_HEADER_WORDS = 10    # 4-byte words of event header included in a store's event size
+
+
+def _issue(kind, message, store=None, fatal=True, **details):
+    issue = {'kind': kind, 'store': store, 'fatal': fatal, 'message': message}
+    issue.update(details)
+    return issue
+
+
+def check_block(path, stores=None, header=None, sev_files=None):
+    """Check a TDT block for missing or truncated files, from the TSQ index and file sizes alone.
+
+    Parameters
+    ----------
+    path: str
+        Path to TDT folder
+    stores: list, optional
+        Names of the stream stores that must be present (alternative names, e.g. 'ECoG',
+        are resolved as in TDTReader). Missing or truncated files of other stores are reported
+        as non-fatal issues. Defaults to None, which requires no store to be present,
+        but treats missing or truncated files of all stream stores as fatal.
+    header: tdt.StructType, optional
+        Headers already parsed by tdt.read_block(path, headers=1). Parsed from the TSQ file if None.
+    sev_files: dict, optional
+        SEV files of the block, as returned by find_sev_files(). Searched for if None.
+
+    Returns
+    -------
+    report: dict
+        'ok': False if any fatal issue was found.
+        'issues': list of dicts, each with the 'kind' of issue ('missing_file', 'truncated_tsq',
+        'no_stop_marker', 'missing_store', 'truncated_store' or 'channel_mismatch'),
+        the 'store' it concerns (or None), whether it is 'fatal', a readable 'message',
+        and some details depending on the kind.
+    """
+    issues = []
+    tsq_files = tdt.get_files(path, '.tsq', ignore_mac=True)
+    if len(tsq_files) != 1:
+        issues.append(_issue('missing_file', f'Expected one TSQ file in {path}, found {len(tsq_files)}.'))
+        return {'ok': False, 'issues': issues}
+    tsq_size = os.path.getsize(tsq_files[0])
+    if tsq_size % TSQ_RECORD_SIZE != 0:
+        issues.append(_issue('truncated_tsq', f'TSQ file ends in a partial record ({tsq_size} bytes).',
+                             fatal=False, num_bytes=tsq_size))
+
+    if header is None:
+        try:
+            header = tdt.read_block(path, headers=1)
+        except Exception as e:
+            issues.append(_issue('truncated_tsq', f'Unable to parse the TSQ file: {e}'))
+            return {'ok': False, 'issues': issues}
+    if sev_files is None:
+        sev_files = find_sev_files(path)
+
+    if np.isnan(np.atleast_1d(header['stop_time'])[0]):
+        issues.append(_issue('no_stop_marker', 'TSQ file has no stop marker; recording did not end normally.',
+                             fatal=False))
+
+    stream_stores = {name: store for name, store in header['stores'].items()
+                     if store['type_str'] == 'streams'}
+    for name in stores or []:
+        available = list(stream_stores.keys()) + list(sev_files.keys())
+        if name not in available and stream_alternatives.get(name, name) not in available:
+            issues.append(_issue('missing_store', f"Store '{name}' not found.", store=name))
+    if stores is None:
+        required = set(stream_stores.keys())
+    else:
+        required = set(stores) | {stream_alternatives.get(name, name) for name in stores}
+
+    tev_path = header['tev_path']
+    tev_size = os.path.getsize(tev_path) if os.path.exists(tev_path) else None
+    for name, store in stream_stores.items():
+        chan = np.asarray(store['chan'])
+        channel_ids, events_per_channel = np.unique(chan, return_counts=True)
+        if events_per_channel.min() != events_per_channel.max():
+            issues.append(_issue('channel_mismatch',
+                                 f"Store '{name}' has {events_per_channel.min()} to "
+                                 f"{events_per_channel.max()} events per channel.",
+                                 store=name, fatal=False,
+                                 channel_ids=channel_ids.tolist(),
+                                 events_per_channel=events_per_channel.tolist()))
+
+        # files of stores that are not converted do not prevent the conversion
+        fatal = name in required
+        if store['ucf']:
+            issues += _check_sev_store(name, store, channel_ids, events_per_channel, sev_files, fatal=fatal)
+            continue
+
+        if tev_size is None:
+            issues.append(_issue('missing_file', f'TEV file {tev_path} not found.', store=name, fatal=fatal))
+            continue
+        event_bytes = (int(store['size']) - EVENT_HEADER_WORDS) * 4
+        event_ends = np.asarray(store['data'], dtype=np.uint64) + np.uint64(event_bytes)
+        num_truncated = int(np.count_nonzero(event_ends > tev_size))
+        if num_truncated > 0:
+            issues.append(_issue('truncated_store',
+                                 f"Store '{name}': {num_truncated} of {len(event_ends)} events "
+                                 f"are past the end of the TEV file.",
+                                 store=name, fatal=fatal, expected_bytes=int(event_ends.max()),
+                                 available_bytes=tev_size, num_truncated_events=num_truncated))
+
+    ok = not any(issue['fatal'] for issue in issues)
+    return {'ok': ok, 'issues': issues}
+
+
+def _check_sev_store(name, store, channel_ids, events_per_channel, sev_files, fatal=True):
+    """Check the SEV files of a store against the number of samples in the TSQ index.
+    """
+    if name not in sev_files:
+        return [_issue('missing_file', f"Store '{name}' is saved in SEV files, but none were found.",
+                       store=name, fatal=fatal)]
+
+    issues = []
+    dtype = np.dtype(tdt.ALLOWED_FORMATS[store['dform']])
+    samples_per_event = (int(store['size']) - EVENT_HEADER_WORDS) * 4 // dtype.itemsize
+    for ch, num_events in zip(channel_ids, events_per_channel):
+        files = sev_files[name].get(int(ch), [])
+        if len(files) == 0:
+            issues.append(_issue('missing_file', f"Store '{name}': SEV file for channel {ch} not found.",
+                                 store=name, fatal=fatal, channel=int(ch)))
+            continue
+        expected = samples_per_event * int(num_events)
+        available = sum(header['num_samples'] for header in files)
+        if available < expected:
+            issues.append(_issue('truncated_store',
+                                 f"Store '{name}': channel {ch} has {available} of {expected} samples.",
+                                 store=name, fatal=fatal, channel=int(ch),
+                                 expected_samples=expected, available_samples=available))
+    return issues
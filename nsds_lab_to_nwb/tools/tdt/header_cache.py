@@ -0,0 +1,114 @@
+import logging.config
+import os
+
+import numpy as np
+import tdt
+
+from nsds_lab_to_nwb.tools.cache import keyed_cache_path, save_npz
+
+logger = logging.getLogger(__name__)
+
+
+# values of these types are restored as python objects (not numpy scalars or arrays)
+_python_types = (str, bool, int, float, list)
+
+
+def get_cache_path(path, cache_dir):
+    """Get the path of the cached headers of a TDT block.
+
+    The file name is keyed by the path, size and modification time of the TSQ file
+    (and by the tdt version), so a cache file is never reused for a changed block.
+
+    Parameters
+    ----------
+    path: str
+        Path to TDT folder
+    cache_dir: str
+        Directory of the cache files.
+
+    Returns
+    -------
+    cache_path: str
+        Path to the .npz cache file, or None if the block has no TSQ file.
+    """
+    tsq_files = tdt.get_files(path, '.tsq', ignore_mac=True)
+    if len(tsq_files) != 1:
+        return None
+    tsq_path = os.path.abspath(tsq_files[0])
+    tsq_stat = os.stat(tsq_path)
+    block_name = os.path.basename(os.path.normpath(path))
+    return keyed_cache_path(cache_dir, block_name, tsq_path, tsq_stat.st_size, tsq_stat.st_mtime_ns,
+                            tdt.__version__)
+
+
+def _flatten(struct, prefix=''):
+    flat = {}
+    python_keys = []
+    for key, value in struct.items():
+        name = prefix + key
+        if isinstance(value, (dict, tdt.StructType)):
+            sub_flat, sub_python_keys = _flatten(value, prefix=name + '/')
+            flat.update(sub_flat)
+            python_keys += sub_python_keys
+            flat.setdefault(name + '/', np.empty(0))    # marks an (empty) struct
+            continue
+        if isinstance(value, _python_types) and not isinstance(value, np.generic):
+            python_keys.append(name)
+        flat[name] = np.asarray(value)
+    return flat, python_keys
+
+
+def _unflatten(flat, python_keys):
+    header = tdt.StructType()
+    for name, value in flat.items():
+        *parents, key = name.split('/')
+        struct = header
+        for parent in parents:
+            if parent not in struct.keys():
+                struct[parent] = tdt.StructType()
+            struct = struct[parent]
+        if key == '':
+            continue
+        if name in python_keys:
+            value = value.tolist()
+        elif value.ndim == 0:
+            value = value[()]
+        struct[key] = value
+    return header
+
+
+def read_headers(path, cache_dir=None):
+    """Parse the TSQ headers of a TDT block, as tdt.read_block(path, headers=1) does,
+    reusing the parsed headers from an earlier run if they were cached.
+
+    Parameters
+    ----------
+    path: str
+        Path to TDT folder
+    cache_dir: str, optional
+        Directory to keep the parsed headers in, as one .npz file per block
+        (see get_cache_path()). Defaults to None (no caching).
+
+    Returns
+    -------
+    header: tdt.StructType
+        Parsed headers, to pass to tdt.read_block(path, headers=header).
+    """
+    cache_path = None if cache_dir is None else get_cache_path(path, cache_dir)
+    if cache_path is not None and os.path.exists(cache_path):
+        logger.debug(f'Loading cached TDT headers from {cache_path}')
+        with np.load(cache_path) as cached:
+            flat = {name: cached[name] for name in cached.files}
+        python_keys = set(flat.pop('__python_keys__').tolist())
+        return _unflatten(flat, python_keys)
+
+    header = tdt.read_block(path, headers=1)
+    if cache_path is not None:
+        flat, python_keys = _flatten(header)
+        if any(value.dtype.hasobject for value in flat.values()):
+            logger.debug(f'TDT headers of {path} cannot be cached')
+            return header
+        os.makedirs(cache_dir, exist_ok=True)
+        save_npz(cache_path, __python_keys__=np.array(python_keys, dtype=str), **flat)
+        logger.debug(f'Cached TDT headers to {cache_path}')
+    return header
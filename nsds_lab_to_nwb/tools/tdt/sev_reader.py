@@ -0,0 +1,167 @@
+import logging.config
+import os
+import re
+
+import numpy as np
+import tdt
+
+logger = logging.getLogger(__name__)
+
+
+SEV_HEADER_LENGTH = 40
+SEV_HEADER_DTYPE = np.dtype([('size_bytes', '<u8'),
+                             ('file_type', 'S3'),
+                             ('file_version', 'u1'),
+                             ('event_name', 'S4'),
+                             ('channel_num', '<u2'),
+                             ('total_num_channels', '<u2'),
+                             ('sample_width_bytes', '<u2'),
+                             ('reserved', '<u2'),
+                             ('data_format', 'u1'),
+                             ('decimate', 'u1'),
+                             ('rate', '<u2')])
+
+_hour_search = re.compile('-([0-9]*)h')
+_name_search = re.compile('(?=_(.{4})_)')
+
+
+def read_sev_header(path):
+    """Read the 40-byte header of a SEV file.
+
+    Parameters
+    ----------
+    path: str
+        Path to the SEV file.
+
+    Returns
+    -------
+    header: dict
+        event_name, channel, dtype, sample_rate and hour of the file,
+        and num_samples of the payload that follows the header.
+    """
+    with open(path, 'rb') as f:
+        raw = np.frombuffer(f.read(SEV_HEADER_DTYPE.itemsize), dtype=SEV_HEADER_DTYPE)[0]
+    if raw['file_type'] != b'SEV' or not 0 < raw['file_version'] < 4:
+        raise ValueError(f'Unsupported SEV header in {path}')
+
+    name = os.path.splitext(os.path.basename(path))[0]
+    if raw['file_version'] >= 3:
+        event_name = raw['event_name'].decode('cp437')
+    else:
+        # older versions did not set the event name reliably; use the file name
+        matches = _name_search.findall(name)
+        event_name = matches[-1] if matches else name
+    hour = _hour_search.findall(name)
+
+    data_format = tdt.ALLOWED_FORMATS[raw['data_format'] & 0b111]
+    if not isinstance(data_format, type):
+        raise ValueError(f'Unsupported SEV data format in {path}')
+    dtype = np.dtype(data_format)
+
+    header = {}
+    header['event_name'] = event_name
+    header['channel'] = int(raw['channel_num'])
+    header['hour'] = int(hour[-1]) if hour else 0
+    header['dtype'] = dtype
+    header['sample_rate'] = 2. ** (float(raw['rate']) - 12) * 25000000 / raw['decimate']
+    header['num_samples'] = (os.path.getsize(path) - SEV_HEADER_LENGTH) // dtype.itemsize
+    return header
+
+
+def find_sev_files(path):
+    """Find the SEV files of a TDT block and group them by store and channel.
+
+    Parameters
+    ----------
+    path: str
+        Path to TDT folder
+
+    Returns
+    -------
+    sev_files: dict
+        {store name: {channel id: [SEV file headers, in order of recording hour]}}.
+        Each header also holds the path to its file.
+    """
+    sev_files = {}
+    for sev_path in tdt.get_files(path, '.sev', ignore_mac=True):
+        header = read_sev_header(sev_path)
+        header['path'] = sev_path
+        channels = sev_files.setdefault(header['event_name'], {})
+        channels.setdefault(header['channel'], []).append(header)
+    for channels in sev_files.values():
+        for files in channels.values():
+            files.sort(key=lambda header: header['hour'])
+    return sev_files
+
+
+class SEVStream:
+    """Memory-mapped (time, channel) view of a TDT stream store saved as SEV files.
+
+    Each channel file is mapped with np.memmap, so slicing reads only the requested
+    samples from disk and returns them as a contiguous, time-major array.
+    Recordings split into hourly files are joined along time.
+    Gaps reported in the SEV log files are not filled in.
+
+    Parameters
+    ----------
+    channel_files: dict
+        {channel id: [SEV file headers]} for a single store, as returned by find_sev_files().
+    channels: list, optional
+        List of channel ids to expose. Defaults to None (all channels, in ascending order).
+    sample_rate: float, optional
+        Sample rate to report instead of the one computed from the SEV headers
+        (the TSQ headers have the exact rate).
+    """
+    def __init__(self, channel_files, channels=None, sample_rate=None):
+        if channels is None:
+            channels = sorted(channel_files.keys())
+        self.channel_ids = list(channels)
+
+        first_files = channel_files[self.channel_ids[0]]
+        self.event_name = first_files[0]['event_name']
+        self.dtype = first_files[0]['dtype']
+        self.sample_rate = sample_rate or first_files[0]['sample_rate']
+
+        # per channel, a list of memmaps, one per hourly file
+        self._segments = []
+        for ch in self.channel_ids:
+            self._segments.append([np.memmap(header['path'], dtype=self.dtype, mode='r',
+                                             offset=SEV_HEADER_LENGTH, shape=(header['num_samples'],))
+                                   for header in channel_files[ch]])
+        # channels can differ by a few samples at the end; keep what all channels have
+        num_samples = min(sum(len(segment) for segment in segments)
+                          for segments in self._segments)
+        self.shape = (num_samples, len(self.channel_ids))
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key, slice(None))
+        time_key, channel_key = key
+        if not isinstance(time_key, slice):
+            raise TypeError('SEVStream only supports slices along the time axis')
+        start, stop, step = time_key.indices(self.shape[0])
+        if step != 1:
+            raise ValueError('SEVStream does not support strided time slices')
+        stop = max(start, stop)
+        channel_indices = np.arange(self.shape[1])[channel_key]
+
+        out = np.empty((stop - start, np.size(channel_indices)), dtype=self.dtype)
+        for j, ch_index in enumerate(np.atleast_1d(channel_indices)):
+            self._read_channel(ch_index, start, stop, out[:, j])
+        if np.ndim(channel_indices) == 0:
+            return out[:, 0]
+        return out
+
+    def _read_channel(self, ch_index, start, stop, out):
+        """Copy samples [start, stop) of one channel into out, across hourly files.
+        """
+        segment_start = 0
+        for segment in self._segments[ch_index]:
+            segment_stop = segment_start + len(segment)
+            lo, hi = max(start, segment_start), min(stop, segment_stop)
+            if lo < hi:
+                out[lo - start:hi - start] = segment[lo - segment_start:hi - segment_start]
+            segment_start = segment_stop
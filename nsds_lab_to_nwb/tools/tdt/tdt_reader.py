@@ -1,12 +1,76 @@
 import logging.config
+import os
+from datetime import datetime
+
+import numpy as np
 import tdt
 
+from nsds_lab_to_nwb.tools.tdt.header_cache import read_headers
+from nsds_lab_to_nwb.tools.tdt.sev_reader import SEVStream, find_sev_files
+from nsds_lab_to_nwb.tools.stream_iterator import StreamIterator
+
 logger = logging.getLogger(__name__)
 
 
 stream_alternatives = {'ECoG': 'Wave'}
 
 
+def probe_block(path, header=None):
+    """Summarize a TDT block from its TSQ headers, without reading any sample data.
+
+    Parameters
+    ----------
+    path: str
+        Path to TDT folder
+    header: tdt.StructType, optional
+        Headers already parsed by tdt.read_block(path, headers=1). Parsed from the TSQ file if None.
+
+    Returns
+    -------
+    probe: dict
+        'info': block info, with the same keys as tdt_obj['info'] for start and stop times.
+        'streams': for each stream store, a dict with sample_rate, channel_ids, num_channels,
+        num_samples and dtype.
+        'epocs': for each epoc store (e.g. 'mark'), the onset times in seconds from the block start,
+        read from the TSQ records alone.
+    """
+    if header is None:
+        header = tdt.read_block(path, headers=1)
+
+    tankpath, blockname = os.path.split(os.path.normpath(path))
+    info = {'tankpath': tankpath, 'blockname': blockname}
+    start_time = np.atleast_1d(header['start_time'])[0]
+    stop_time = np.atleast_1d(header['stop_time'])[0]
+    info['start_date'] = datetime.fromtimestamp(start_time)
+    info['utc_start_time'] = info['start_date'].strftime('%H:%M:%S')
+    if np.isnan(stop_time):
+        info['stop_date'] = np.nan
+        info['utc_stop_time'] = np.nan
+    else:
+        info['stop_date'] = datetime.fromtimestamp(stop_time)
+        info['utc_stop_time'] = info['stop_date'].strftime('%H:%M:%S')
+        info['duration'] = info['stop_date'] - info['start_date']
+
+    streams = {}
+    epocs = {}
+    for name, store in header['stores'].items():
+        if store['type_str'] == 'epocs':
+            epocs[name] = np.array(store['onset'])
+        if store['type_str'] != 'streams':
+            continue
+        dtype = np.dtype(tdt.ALLOWED_FORMATS[store['dform']])
+        # each event holds a 10-word (40 byte) header followed by the samples of one channel
+        samples_per_event = (int(store['size']) - 10) * 4 // dtype.itemsize
+        channel_ids = [int(ch) for ch in np.unique(store['chan'])]
+        num_events = len(store['data'])
+        streams[name] = {'sample_rate': store['fs'],
+                         'channel_ids': channel_ids,
+                         'num_channels': len(channel_ids),
+                         'num_samples': samples_per_event * num_events // len(channel_ids),
+                         'dtype': dtype}
+    return {'info': info, 'streams': streams, 'epocs': epocs}
+
+
 class TDTReader:
     """TDT interface
 
@@ -16,15 +80,44 @@ class TDTReader:
         Path to TDT folder
     channels: list, optional
         List of channel ids to import. Defaults to None.
+    stores: list, optional
+        Names of the stream stores that will be read. If given, only the TSQ headers
+        (and the epocs) are parsed on creation, and each store is decoded the first
+        time it is requested. Stores that are not listed are never decoded.
+        Defaults to None, which decodes the whole block on creation (unless memmap_sev is set).
+    memmap_sev: bool, optional
+        Memory-map the streams that are saved as SEV files instead of decoding them.
+        get_data() then returns a StreamIterator over the (time, channel) view of the files,
+        so no copy of the stream is held in memory. Defaults to False.
+    drop_bad_chs: bool, optional
+        Leave the channels listed in dev_conf['bad_chs'] out of the data returned by get_data().
+        Defaults to False.
+    cache_dir: str, optional
+        Directory to cache the parsed TSQ headers in, so that reading the block again
+        skips parsing the TSQ file (see header_cache.read_headers()).
+        Only used when the headers are parsed separately (stores or memmap_sev given).
+        Defaults to None (no caching).
     """
-    def __init__(self, path, channels=None):
+    def __init__(self, path, channels=None, stores=None, memmap_sev=False, drop_bad_chs=False,
+                 cache_dir=None):
         self.path = path
         self.channels = channels
+        self.stores = stores
+        self.drop_bad_chs = drop_bad_chs
+        self.sev_files = find_sev_files(path) if memmap_sev else {}
 
-        if channels is None:
-            self.tdt_obj = tdt.read_block(path)
+        if stores is None and not memmap_sev:
+            self.header = None
+            if channels is None:
+                self.tdt_obj = tdt.read_block(path)
+            else:
+                self.tdt_obj = tdt.read_block(path, channel=channels)
         else:
-            self.tdt_obj = tdt.read_block(path, channel=channels)
+            # block info and epocs are available from the headers alone;
+            # streams are filled in by _read_stream() on demand
+            self.header = read_headers(path, cache_dir=cache_dir)
+            self.tdt_obj = tdt.read_block(path, headers=self.header, evtype=['epocs'])
+            self.probe_info = probe_block(path, header=self.header)
 
         self.streams = self.get_streams()
         self.block_name = self.tdt_obj['info']['blockname']
@@ -38,9 +131,109 @@ class TDTReader:
         Returns:
             streams (list): stream names
         """
-        streams = list(self.tdt_obj['streams'].keys())
+        if self.header is None:
+            streams = list(self.tdt_obj['streams'].keys())
+            return streams
+
+        available = [name for name, store in self.header['stores'].items()
+                     if store['type_str'] == 'streams']
+        available += [name for name in self.sev_files if name not in available]
+        if self.stores is None:
+            return available
+
+        streams = []
+        for store in self.stores:
+            if store not in available:
+                store = stream_alternatives.get(store, store)
+            if store in available:
+                streams.append(store)
+            else:
+                logger.warning(f"Store '{store}' not found in block {self.path}. "
+                               f"Available streams: [{', '.join(available)}]")
         return streams
 
+    def get_channels(self, stream, dev_conf=None):
+        """Get the ids of the channels to read from a stream.
+
+        Parameters
+        ----------
+        stream: str
+            Stream name, after check_stream().
+        dev_conf: dict, optional
+            Metadata for the device. If it has a ch_map, only the mapped channels are read,
+            in the order of the ch_map (without the bad_chs if drop_bad_chs is set).
+
+        Returns
+        -------
+        channels: list
+            Channel ids, or None to read all channels of the stream.
+        """
+        if dev_conf is None or 'ch_map' not in dev_conf:
+            channels = self.channels
+        else:
+            channels = [int(ch) for ch in dev_conf['ch_map'].keys()]
+            if self.drop_bad_chs:
+                bad_chs = dev_conf.get('bad_chs') or []
+                channels = [ch for ch in channels if ch not in bad_chs]
+            if self.channels is not None:
+                channels = [ch for ch in channels if ch in self.channels]
+        if channels is None:
+            return None
+
+        if stream in self.sev_files:
+            available = sorted(self.sev_files[stream].keys())
+        elif self.header is None:
+            available = list(self.tdt_obj['streams'][stream]['channel'])
+        else:
+            available = self.probe_info['streams'][stream]['channel_ids']
+        missing = [ch for ch in channels if ch not in available]
+        if len(missing) > 0:
+            logger.warning(f"Channels {missing} not found in stream '{stream}'.")
+        return [ch for ch in channels if ch in available]
+
+    def _read_stream(self, stream, channels=None):
+        """Decode a single stream store into self.tdt_obj, if not already done.
+
+        Parameters
+        ----------
+        stream: str
+            Stream name, after check_stream().
+        channels: list, optional
+            Channel ids to decode. Defaults to None (all channels).
+        """
+        if stream in self.tdt_obj['streams'].keys():
+            decoded = self.tdt_obj['streams'][stream]['channel']
+            if channels is None or set(channels) <= set(decoded):
+                return
+
+        logger.debug(f'Decoding TDT store {stream}...')
+        # pass a copy of the headers that only lists this store,
+        # so that read_block does not decode the other streams
+        header = tdt.StructType()
+        for key, value in self.header.items():
+            header[key] = value
+        header['stores'] = tdt.StructType()
+        header['stores'][stream] = self.header['stores'][stream]
+
+        channel = 0 if channels is None else channels
+        block = tdt.read_block(self.path, headers=header, evtype=['streams'], channel=channel)
+        self.tdt_obj['streams'][stream] = block['streams'][stream]
+
+    def decode(self, stream, dev_conf=None):
+        """Decode a stream store ahead of get_data(), e.g. from a worker thread.
+        Stores that are memory-mapped as SEV files are left as they are.
+
+        Parameters
+        ----------
+        stream: str
+            Stream name
+        dev_conf: (dict) metadata for the device, as passed to get_data().
+        """
+        stream = self.check_stream(stream)
+        if stream in self.sev_files:
+            return
+        self._read_stream(stream, self.get_channels(stream, dev_conf))
+
     def get_metadata(self, stream):
         """Get specified stream metadata
 
@@ -51,6 +244,12 @@ class TDTReader:
             meta (dict): dictionary containing stream recording parameters (if no stream returns None)
         """
         stream = self.check_stream(stream)
+        if stream in self.sev_files:
+            return self._get_sev_metadata(self._get_sev_stream(stream, self.get_channels(stream)))
+        if stream not in self.tdt_obj['streams'].keys():
+            # not decoded (yet); answer from the headers
+            return self._get_header_metadata(stream)
+
         meta = {}
         meta['sample_rate'] = self.tdt_obj['streams'][stream]['fs']
         meta['channel_ids'] = self.tdt_obj['streams'][stream]['channel']
@@ -63,6 +262,39 @@ class TDTReader:
             meta['num_channels'], meta['num_samples'] = data_shape
         return meta
 
+    def _get_header_metadata(self, stream):
+        """Get stream metadata from the TSQ headers, without decoding the stream.
+        """
+        stream_probe = self.probe_info['streams'][stream]
+        meta = {}
+        meta['sample_rate'] = stream_probe['sample_rate']
+        meta['channel_ids'] = stream_probe['channel_ids']
+        if self.channels is not None:
+            meta['channel_ids'] = [ch for ch in meta['channel_ids'] if ch in self.channels]
+        meta['start_time'] = self.tdt_obj['info']['utc_start_time']
+        meta['num_samples'] = stream_probe['num_samples']
+        meta['num_channels'] = len(meta['channel_ids'])
+        return meta
+
+    def _get_sev_stream(self, stream, channels=None):
+        """Memory-map the SEV files of a stream (only the files of the given channels).
+        """
+        sample_rate = None
+        if stream in self.probe_info['streams']:
+            # the TSQ headers have the exact rate
+            sample_rate = self.probe_info['streams'][stream]['sample_rate']
+        return SEVStream(self.sev_files[stream], channels=channels, sample_rate=sample_rate)
+
+    def _get_sev_metadata(self, sev_stream):
+        """Get stream metadata from the SEV file headers and sizes.
+        """
+        meta = {}
+        meta['sample_rate'] = sev_stream.sample_rate
+        meta['channel_ids'] = sev_stream.channel_ids
+        meta['start_time'] = self.tdt_obj['info']['utc_start_time']
+        meta['num_samples'], meta['num_channels'] = sev_stream.shape
+        return meta
+
     def check_stream(self, stream):
         """Checks to see if user specified stream (or alternative name) exists in data.
 
@@ -94,18 +326,42 @@ class TDTReader:
         stream: str
             Stream name
         dev_conf: (dict) metadata for the device.
-            nwb_builder.metadata['device'][device_name]. Not used for TDT.
+            nwb_builder.metadata['device'][device_name].
+            Only the channels in dev_conf['ch_map'] are read, if given (see get_channels()).
 
         Returns
         -------
-        data: ndarray
-            Data array
+        data: ndarray or StreamIterator
+            Data array of shape (time, channel), or an iterator over the memory-mapped SEV files in
+            memmap_sev mode, or over the decoded stream if its channels are reordered to the ch_map.
+            When the stores are decoded on demand, the reader does not keep a reference to the data.
         meta: dict
             Meta data for the data array.
         """
         stream = self.check_stream(stream)
+        channels = self.get_channels(stream, dev_conf)
+        if stream in self.sev_files:
+            sev_stream = self._get_sev_stream(stream, channels)
+            data = StreamIterator(sev_stream)
+            meta = self._get_sev_metadata(sev_stream)
+            return data, meta
+
+        self._read_stream(stream, channels)
         data = self.tdt_obj['streams'][stream]['data'].T
         meta = self.get_metadata(stream)
+        if channels is not None and data.ndim > 1:
+            # tdt returns the channels in ascending order; pick them in the requested order
+            decoded = list(self.tdt_obj['streams'][stream]['channel'])
+            index = [decoded.index(ch) for ch in channels]
+            if index != list(range(len(decoded))):
+                # reorder block by block rather than copying the whole stream
+                data = StreamIterator(data, columns=index)
+            meta['channel_ids'] = channels
+            meta['num_channels'] = len(channels)
+        if self.header is not None:
+            # hand the decoded stream over, so it is freed as soon as the caller is done with it
+            # (it is decoded again if requested again)
+            delattr(self.tdt_obj['streams'], stream)  # tdt structs keep their items as attributes
         return data, meta
 
     def get_events(self):
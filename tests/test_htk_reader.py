@@ -0,0 +1,480 @@
+import multiprocessing
+import os
+import pickle
+from multiprocessing import shared_memory
+from struct import pack
+
+import numpy as np
+import pytest
+
+from nsds_lab_to_nwb.tools.htk.readers.htkcollection import HTKChannelIterator, HTKCollection, HTKTimeIterator
+from nsds_lab_to_nwb.common.data_scanners import Dataset
+from nsds_lab_to_nwb.common.rec_manager import RecManager
+from nsds_lab_to_nwb.components.stimulus.mark_manager import MarkManager
+from nsds_lab_to_nwb.components.stimulus.utils import detect_events
+from nsds_lab_to_nwb.tools.htk.htk_reader import HTKReader
+from nsds_lab_to_nwb.tools.htk.readers import htkindex
+from nsds_lab_to_nwb.tools.htk.readers.htkfile import HTKFile, HTKFilePool, header_mismatches, read_headers
+from nsds_lab_to_nwb.tools.htk.readers.htkindex import get_directory_index
+from nsds_lab_to_nwb.tools.stream_iterator import StreamIterator
+
+
+SAMPLE_RATE = 3051.7578125
+
+
+def write_htk_file(path, data, sample_rate=SAMPLE_RATE):
+    '''Write a (time, band) float32 array as an uncompressed HTK file (USER parameter kind),
+    with the sample rate stored in units of 1/10000 Hz.
+    '''
+    num_samples, vector_length = data.shape
+    with open(path, 'wb') as f:
+        f.write(pack('>IIHH', num_samples, int(sample_rate * 10000), 4 * vector_length, 9))
+        f.write(data.astype('>f4').tobytes())
+
+
+def write_compressed_htk_file(path, raw, A, B, sample_rate=SAMPLE_RATE):
+    '''Write a (time, band) int16 array as a compressed (_C) HTK file with the scale A and offset B.
+    '''
+    num_samples, vector_length = raw.shape
+    with open(path, 'wb') as f:
+        # the A and B vectors are counted as 4 samples
+        f.write(pack('>IIHH', num_samples + 4, int(sample_rate * 10000), 2 * vector_length, 9 | 0o2000))
+        f.write(np.asarray(A, dtype='>f4').tobytes())
+        f.write(np.asarray(B, dtype='>f4').tobytes())
+        f.write(raw.astype('>i2').tobytes())
+
+
+@pytest.fixture
+def htk_dir(tmp_path):
+    rng = np.random.default_rng(0)
+    data = rng.standard_normal((16, 1000, 1)).astype('float32')
+    for ch in range(data.shape[0]):
+        write_htk_file(str(tmp_path / f'Wav{ch + 1}.htk'), data[ch])
+    return str(tmp_path), data
+
+
+def test_htk_file(htk_dir):
+    path, data = htk_dir
+    with HTKFile(os.path.join(path, 'Wav3.htk')) as htk_file:
+        assert htk_file.num_samples == 1000
+        assert htk_file.sample_rate == pytest.approx(SAMPLE_RATE, abs=1e-4)
+        np.testing.assert_array_equal(htk_file.read_data(), data[2])
+        np.testing.assert_array_equal(htk_file.read_sample(5), data[2, 5])
+    assert htk_file.closed
+
+
+def test_htk_file_slicing(htk_dir):
+    path, data = htk_dir
+    with HTKFile(os.path.join(path, 'Wav3.htk')) as htk_file:
+        np.testing.assert_array_equal(htk_file.read_range(100, 200), data[2, 100:200])
+        np.testing.assert_array_equal(htk_file.read_range(990, 2000), data[2, 990:])
+        for key in [np.s_[100:200], np.s_[-10:], np.s_[::7], np.s_[500:100:-3], np.s_[5:5],
+                    np.s_[100:200, 0], 42, -1, (42, 0)]:
+            np.testing.assert_array_equal(htk_file[key], data[2][key])
+        with pytest.raises(IndexError):
+            htk_file[1000]
+        # iteration reads blocks of samples, and stops at the end of the file
+        htk_file.iter_block_size = 64
+        np.testing.assert_array_equal(np.array(list(htk_file)), data[2])
+
+
+def test_compressed_htk_file(tmp_path):
+    rng = np.random.default_rng(1)
+    raw = rng.integers(-32767, 32767, size=(1000, 8), dtype='int16')
+    A = rng.uniform(100, 1000, size=8).astype('f')
+    B = rng.uniform(-10, 10, size=8).astype('f')
+    expected = (raw.astype('f') + B) / A
+    filename = str(tmp_path / 'Wav1.htk')
+    write_compressed_htk_file(filename, raw, A, B)
+    with HTKFile(filename) as htk_file:
+        assert htk_file.num_samples == 1000
+        assert htk_file.vector_length == 8
+        htk_file.decompress_chunk_bytes = 4 * 8 * 30    # 30 samples per chunk
+        np.testing.assert_allclose(htk_file.read_range(10, 500), expected[10:500], rtol=1e-6)
+        np.testing.assert_allclose(htk_file[-1], expected[-1], rtol=1e-6)
+        data = htk_file.read_data()
+        assert data.dtype == np.float32
+        np.testing.assert_allclose(data, expected, rtol=1e-6)
+
+
+def test_read_into(htk_dir):
+    path, data = htk_dir
+    out = np.zeros((3, 1000, 1), dtype='float32')
+    with HTKFile(os.path.join(path, 'Wav3.htk')) as htk_file:
+        htk_file.read_into(out[1])
+        np.testing.assert_array_equal(out[1], data[2])
+        assert not out[0].any() and not out[2].any()
+        htk_file.read_into(out[2, :10], start=990)
+        np.testing.assert_array_equal(out[2, :10], data[2, 990:])
+        with pytest.raises(ValueError):
+            htk_file.read_into(out[2, :20], start=990)
+        # read through a memory map into a non-contiguous array of another dtype
+        out64 = np.zeros((1000, 2), dtype='float64')
+        htk_file.read_into(out64[:, :1])
+        np.testing.assert_array_equal(out64[:, 0], data[2, :, 0])
+
+
+def test_file_pool(htk_dir):
+    path, data = htk_dir
+    filenames = [os.path.join(path, f'Wav{ch + 1}.htk') for ch in range(4)]
+    with HTKFilePool(max_open_files=2) as pool:
+        first_file = pool.get(filenames[0])
+        assert pool.get(filenames[0]) is first_file
+        pool.get(filenames[1])
+        pool.get(filenames[2])
+        # the least recently used file was closed
+        assert len(pool) == 2
+        assert first_file.closed
+        np.testing.assert_array_equal(pool.get(filenames[0]).read_data(), data[0])
+        open_files = [pool.get(filename) for filename in filenames[2:]]
+    assert all(htk_file.closed for htk_file in open_files)
+
+
+def test_htk_collection(htk_dir):
+    path, data = htk_dir
+    collection = HTKCollection(path, prefix='Wav', max_open_files=4)
+    assert collection.shape == (16, 1000, 1)
+    np.testing.assert_array_equal(collection.read_channel(7), data[7])
+    assert len(collection.file_pool) <= 4
+
+    data_iterator = HTKChannelIterator.from_htk_collection(collection, time_axis_first=True,
+                                                           has_bands=False)
+    out = np.empty(data_iterator.maxshape, dtype=data_iterator.dtype)
+    for chunk in data_iterator:
+        out[chunk.selection] = chunk.data
+    np.testing.assert_array_equal(out, data[:, :, 0].T)
+    assert len(collection.file_pool) == 0
+
+    with HTKCollection(path, prefix='Wav') as collection:
+        np.testing.assert_array_equal(collection.read_data(), data)
+    assert len(collection.file_pool) == 0
+
+
+@pytest.mark.parametrize('workers', [1, 4])
+def test_check_consistency(htk_dir, tmp_path, workers):
+    path, data = htk_dir
+    filenames = [os.path.join(path, f'Wav{ch + 1}.htk') for ch in range(16)]
+    headers = read_headers(filenames, workers=workers)
+    assert headers.shape == (16,)
+    assert (headers['num_samples'] == 1000).all()
+    assert (headers['sample_size'] == 4).all()
+    assert header_mismatches(headers) == {}
+
+    # same file size, but a different sample rate in two files
+    path = tmp_path / 'inconsistent'
+    path.mkdir()
+    for ch in range(16):
+        write_htk_file(str(path / f'Wav{ch + 1}.htk'), data[ch], sample_rate=1000. if ch in (3, 9) else SAMPLE_RATE)
+    with HTKCollection(str(path), check_consistency=False) as collection:
+        mismatches = collection.check_consistency()
+    assert list(mismatches.keys()) == ['sample_period']
+    np.testing.assert_array_equal(mismatches['sample_period'], [3, 9])
+    with pytest.raises(ValueError, match='sample_period'):
+        HTKCollection(str(path))
+
+
+def test_directory_index(htk_dir, tmp_path_factory):
+    path, data = htk_dir
+    write_htk_file(os.path.join(path, 'Other1.htk'), data[0, :10])
+    cache_dir = str(tmp_path_factory.mktemp('cache'))
+    index = get_directory_index(path, cache_dir=cache_dir)
+    assert len(index) == 17
+    # shared in memory, and cached on disk
+    assert get_directory_index(path) is index
+    assert len(os.listdir(cache_dir)) == 1
+    htkindex._shared_indices.clear()
+    cached_index = get_directory_index(path, cache_dir=cache_dir)
+    assert cached_index is not index
+    np.testing.assert_array_equal(cached_index.filenames, index.filenames)
+    np.testing.assert_array_equal(cached_index.headers, index.headers)
+    np.testing.assert_array_equal(cached_index.block_channel_index(noblock=True)[1],
+                                  index.block_channel_index(noblock=True)[1])
+
+    # files are selected and sorted from the index
+    with HTKCollection(path, prefix='Wav', cache_dir=cache_dir) as collection:
+        assert [os.path.basename(filename) for filename in collection.htk_files] == \
+            [f'Wav{ch + 1}.htk' for ch in range(16)]
+        assert len(collection.headers) == 16
+    with HTKCollection(path, prefix='Wav', postfix=np.array([11, 12])) as collection:
+        assert [os.path.basename(filename) for filename in collection.htk_files] == ['Wav11.htk', 'Wav12.htk']
+
+
+def test_channel_iterator_chunks(htk_dir, tmp_path):
+    path, data = htk_dir
+    collection = HTKCollection(path, prefix='Wav')
+    data_iterator = HTKChannelIterator.from_htk_collection(collection, time_axis_first=True,
+                                                           has_bands=False, buffer_size=6)
+    chunks = list(data_iterator)
+    assert [chunk.selection for chunk in chunks] == [np.s_[:, 0:6], np.s_[:, 6:12], np.s_[:, 12:16]]
+    for chunk in chunks:
+        np.testing.assert_array_equal(chunk.data, data[:, :, 0].T[chunk.selection])
+    assert data_iterator.recommended_chunk_shape() == (1000, 6)
+
+    # 5 channels of 4000 bytes per chunk
+    data_iterator = HTKChannelIterator.from_htk_collection(collection, buffer_bytes=20000)
+    assert data_iterator.buffer_size == 5
+    chunks = list(data_iterator)
+    assert len(chunks) == 4
+    for chunk in chunks:
+        np.testing.assert_array_equal(chunk.data, data[chunk.selection])
+    assert data_iterator.recommended_chunk_shape() == (5, 1000, 1)
+
+
+def test_time_iterator(htk_dir):
+    path, data = htk_dir
+    with HTKFile(os.path.join(path, 'Wav2.htk')) as htk_file:
+        np.testing.assert_array_equal(htk_file.read_range(100, 250), data[1, 100:250])
+        assert htk_file.read_range(990, 1100).shape == (10, 1)
+
+    collection = HTKCollection(path, prefix='Wav')
+    data_iterator = HTKTimeIterator.from_htk_collection(collection, has_bands=False, buffer_size=300)
+    assert data_iterator.maxshape == (1000, 16)
+    chunks = list(data_iterator)
+    assert [chunk.selection for chunk in chunks] == [np.s_[0:300, 0:16], np.s_[300:600, 0:16],
+                                                     np.s_[600:900, 0:16], np.s_[900:1000, 0:16]]
+    for chunk in chunks:
+        np.testing.assert_array_equal(chunk.data, data[:, :, 0].T[chunk.selection])
+    assert len(collection.file_pool) == 0
+
+    # windows are a multiple of the recommended chunks
+    data_iterator = HTKTimeIterator.from_htk_collection(collection, buffer_bytes=20000)
+    assert data_iterator.recommended_chunk_shape() == (1000, 16, 1)
+    assert data_iterator.buffer_size == 1000
+
+
+@pytest.mark.parametrize('keep_files_open', [True, False])
+def test_time_iterator_keeps_files_open(htk_dir, monkeypatch, keep_files_open):
+    path, data = htk_dir
+    opened = []
+    init = HTKFile.__init__
+
+    def counting_init(self, filename, *args, **kwargs):
+        opened.append(filename)
+        init(self, filename, *args, **kwargs)
+    monkeypatch.setattr(HTKFile, '__init__', counting_init)
+
+    # fewer open files than channels
+    collection = HTKCollection(path, prefix='Wav', max_open_files=4)
+    del opened[:]
+    data_iterator = HTKTimeIterator.from_htk_collection(collection, has_bands=False, buffer_size=100,
+                                                        keep_files_open=keep_files_open)
+    chunks = [next(data_iterator)]
+    assert collection.file_pool.max_open_files == (16 if keep_files_open else 4)
+    chunks += list(data_iterator)
+    assert len(chunks) == 10
+    np.testing.assert_array_equal(np.concatenate([chunk.data for chunk in chunks]), data[:, :, 0].T)
+    # the limit of the pool is restored at the end
+    assert collection.file_pool.max_open_files == 4
+    if keep_files_open:
+        # each file is opened at most once (some are still open from creating the collection)
+        assert len(opened) == len(set(opened)) <= 16
+    else:
+        assert len(opened) > 16
+
+
+@pytest.mark.parametrize('compressed', [False, True])
+def test_band_selection(tmp_path, compressed):
+    path = tmp_path / 'HilbAA_70to150_4band'
+    path.mkdir()
+    rng = np.random.default_rng(2)
+    raw = rng.integers(-1000, 1000, size=(4, 500, 4), dtype='int16')
+    A = np.array([10, 20, 30, 40], dtype='f')
+    B = np.array([1, 2, 3, 4], dtype='f')
+    data = (raw + B) / A if compressed else raw.astype('f')
+    for ch in range(4):
+        if compressed:
+            write_compressed_htk_file(str(path / f'Wav{ch + 1}.htk'), raw[ch], A, B)
+        else:
+            write_htk_file(str(path / f'Wav{ch + 1}.htk'), data[ch])
+    with HTKFile(str(path / 'Wav2.htk')) as htk_file:
+        np.testing.assert_allclose(htk_file.read_range(10, 20, bands=[1, 3]), data[1, 10:20][:, [1, 3]], rtol=1e-6)
+
+    collection = HTKCollection(str(path), guess_bands=True)
+    time_iterator = HTKTimeIterator.from_htk_collection(collection, bands=[1, 3], buffer_size=200)
+    assert time_iterator.maxshape == (500, 4, 2)
+    for chunk in time_iterator:
+        np.testing.assert_allclose(chunk.data, data.transpose(1, 0, 2)[:, :, [1, 3]][chunk.selection], rtol=1e-6)
+
+    channel_iterator = HTKChannelIterator.from_htk_collection(collection, time_axis_first=True, bands=[2])
+    assert channel_iterator.maxshape == (500, 4, 1)
+    for chunk in channel_iterator:
+        np.testing.assert_allclose(chunk.data, data.transpose(1, 0, 2)[:, :, [2]][chunk.selection], rtol=1e-6)
+
+    # a single band without the band dimension
+    channel_iterator = HTKChannelIterator.from_htk_collection(collection, time_axis_first=True, has_bands=False)
+    assert channel_iterator.bands == [0]
+    with pytest.raises(ValueError):
+        HTKTimeIterator.from_htk_collection(collection, has_bands=False, bands=[0, 1])
+    collection.close()
+
+    # processed data next to the raw HTK folder
+    (tmp_path / 'RawHTK').mkdir()
+    dev_conf = {'prefix': 'Wav', 'ch_ids': np.arange(1, 5), 'device_type': 'ECoG',
+                'htk_dir': 'HilbAA_70to150_4band', 'bands': [0, 3]}
+    band_data, meta = HTKReader(str(tmp_path / 'RawHTK')).get_data(dev_conf=dev_conf)
+    assert band_data.maxshape == (500, 4, 2)
+    assert meta['band_indices'] == [0, 3]
+    assert len(meta['bands']) == 2 and 70 <= meta['bands'][0] < meta['bands'][1] < 150
+
+    # all bands by default
+    del dev_conf['bands']
+    band_data, meta = HTKReader(str(tmp_path / 'RawHTK')).get_data(dev_conf=dev_conf)
+    assert band_data.maxshape == (500, 4, 4)
+    assert meta['band_indices'] == [0, 1, 2, 3] and len(meta['bands']) == 4
+
+
+def test_memmap(htk_dir):
+    path, data = htk_dir
+    with HTKFile(os.path.join(path, 'Wav5.htk'), use_memmap=True) as htk_file:
+        rawdata = htk_file.memmap()
+        assert rawdata.dtype == np.dtype('>f4')
+        assert rawdata.shape == (1000, 1)
+        window = htk_file.to_native(rawdata[200:300])
+        assert window.dtype == np.dtype('=f4')
+        np.testing.assert_array_equal(window, data[4, 200:300])
+        np.testing.assert_array_equal(htk_file.read_range(200, 300), data[4, 200:300])
+        np.testing.assert_array_equal(htk_file.read_data(), data[4])
+
+
+def count_memmap_reads(monkeypatch):
+    '''Count the calls of HTKFile.memmap, i.e., the reads that go through the memory map.
+    '''
+    calls = []
+    memmap = HTKFile.memmap
+
+    def counting_memmap(self):
+        calls.append(self.filename)
+        return memmap(self)
+    monkeypatch.setattr(HTKFile, 'memmap', counting_memmap)
+    return calls
+
+
+@pytest.mark.parametrize('workers', [1, 4])
+@pytest.mark.parametrize('use_memmap', [False, True])
+def test_read_through_memmap(htk_dir, monkeypatch, use_memmap, workers):
+    path, data = htk_dir
+    memmap_reads = count_memmap_reads(monkeypatch)
+    with HTKFile(os.path.join(path, 'Wav5.htk'), use_memmap=use_memmap) as htk_file:
+        np.testing.assert_array_equal(htk_file.read_range(200, 300), data[4, 200:300])
+    assert len(memmap_reads) == (1 if use_memmap else 0)
+
+    del memmap_reads[:]
+    collection = HTKCollection(path, prefix='Wav', use_memmap=use_memmap)
+    np.testing.assert_array_equal(collection.read_data(workers=workers), data)
+    collection.close()
+    # uncompressed files are otherwise read with readinto
+    assert set(memmap_reads) == (set(collection.htk_files) if use_memmap else set())
+
+
+def test_read_data_concurrently(htk_dir, caplog):
+    path, data = htk_dir
+    collection = HTKCollection(path, prefix='Wav')
+    with caplog.at_level('INFO'):
+        np.testing.assert_array_equal(collection.read_data(workers=4), data)
+    assert 'MB/s' in caplog.text
+    assert len(collection.file_pool) <= 1
+
+
+def _shared_channel_sums(shared_data):
+    data = shared_data.attach()
+    sums = data.sum(axis=(1, 2), dtype='float64')
+    data[0, 0, 0] = -1.  # visible to the process that created the segment
+    del data
+    shared_data.close()
+    return sums
+
+
+def test_read_data_shared(htk_dir):
+    path, data = htk_dir
+    collection = HTKCollection(path, prefix='Wav')
+    np.testing.assert_array_equal(collection.read_data(workers=2, shared=True), data)
+    shared_data = pickle.loads(pickle.dumps(collection.shared_data))
+    assert shared_data.shape == data.shape
+    assert shared_data.sample_rate == collection.sample_rate
+
+    with multiprocessing.get_context('spawn').Pool(1) as pool:
+        sums = pool.apply(_shared_channel_sums, (collection.shared_data,))
+    np.testing.assert_allclose(sums, data.sum(axis=(1, 2), dtype='float64'))
+    assert collection.data[0, 0, 0] == -1.
+
+    # clearing the data keeps the returned array valid, and the segment available to other processes
+    shared = collection.data
+    name = collection.shared_data.name
+    collection.clear_data()
+    assert collection.data is None
+    np.testing.assert_array_equal(shared[1:], data[1:])
+    with multiprocessing.get_context('spawn').Pool(1) as pool:
+        sums = pool.apply(_shared_channel_sums, (collection.shared_data,))
+    np.testing.assert_allclose(sums[1:], data[1:].sum(axis=(1, 2), dtype='float64'))
+
+    collection.unlink_shared_data()
+    assert collection.shared_data is None
+    with pytest.raises(FileNotFoundError):
+        shared_memory.SharedMemory(name=name)
+    # the array still maps the memory of the destroyed segment
+    window = shared[2:4]
+    del shared
+    np.testing.assert_array_equal(window, data[2:4])
+    collection.close()
+
+
+@pytest.mark.parametrize('block_size', [7, 100, 2**20])
+def test_detect_events_in_blocks(block_size):
+    mark_rate = 1000.
+    mark_data = np.zeros(1000, dtype='float32')
+    for onset in [0, 99, 100 + 7, 500, 993]:
+        mark_data[onset:onset + 5] = 1.
+    # reference: threshold crossings of the whole track at once
+    crossings = np.diff((np.concatenate(([0.], mark_data)) > 0.5).astype('int'))
+    expected = np.flatnonzero(crossings > 0.5) / mark_rate
+    np.testing.assert_array_equal(detect_events(mark_data, mark_rate, 0.5, block_size=block_size), expected)
+    np.testing.assert_array_equal(detect_events(mark_data, mark_rate, 0.5, min_separation=0.05,
+                                                block_size=block_size), [0., 0.099, 0.5, 0.993])
+    assert len(detect_events(mark_data[:0], mark_rate, 0.5, block_size=block_size)) == 0
+
+
+def test_rec_manager_streams_htk_marks(htk_dir, tmp_path_factory):
+    path, data = htk_dir
+    mark_path = str(tmp_path_factory.mktemp('marks') / 'mrk11.htk')
+    mark_track = np.zeros((5000, 1), dtype='float32')
+    mark_track[[1000, 3000]] = 2.
+    write_htk_file(mark_path, mark_track)
+    dataset = Dataset('R01_B01', path, htk_path=path, htk_mark_path=mark_path)
+    rec_manager = RecManager(dataset, buffer_size=1024)
+
+    mark_data, mark_rate = rec_manager.read_marks()
+    assert mark_rate == pytest.approx(SAMPLE_RATE, abs=1e-4)
+    assert isinstance(mark_data, StreamIterator)
+    assert mark_data.maxshape == (5000,)
+    chunks = list(mark_data)
+    assert len(chunks) == 5
+    assert chunks[0].data.dtype == np.dtype('float32')
+    np.testing.assert_array_equal(np.concatenate([chunk.data for chunk in chunks]), mark_track[:, 0])
+
+    mark_manager = MarkManager(rec_manager, {'mark_threshold': 1., 'duration': 0.1})
+    mark_data, mark_rate, mark_events = mark_manager.get_mark_track()
+    np.testing.assert_allclose(mark_events, np.array([1000, 3000]) / mark_rate)
+
+
+def test_write_big_endian_chunks(htk_dir, tmp_path_factory):
+    from datetime import datetime, timezone
+    from pynwb import NWBFile, NWBHDF5IO, TimeSeries
+
+    path, data = htk_dir
+    collection = HTKCollection(path, use_memmap=True)
+    data_iterator = HTKTimeIterator.from_htk_collection(collection, has_bands=False, buffer_size=300,
+                                                        native_byte_order=False)
+    assert data_iterator.dtype == np.dtype('>f4')
+    # compressed or band-selected data is converted to native floats
+    assert HTKTimeIterator.from_htk_collection(collection, bands=[0]).dtype == np.dtype('float32')
+
+    nwb_content = NWBFile(session_description='test', identifier='test',
+                          session_start_time=datetime(2020, 1, 1, tzinfo=timezone.utc))
+    nwb_content.add_acquisition(TimeSeries(name='htk', data=data_iterator, unit='V', rate=SAMPLE_RATE))
+    nwb_path = str(tmp_path_factory.mktemp('nwb') / 'test.nwb')
+    with NWBHDF5IO(nwb_path, 'w') as io:
+        io.write(nwb_content)
+    with NWBHDF5IO(nwb_path, 'r') as io:
+        written = io.read().acquisition['htk'].data
+        assert written.dtype == np.dtype('float32')
+        np.testing.assert_array_equal(written[:], data[:, :, 0].T)
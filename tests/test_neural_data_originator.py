@@ -0,0 +1,121 @@
+import numpy as np
+import pytest
+from scipy.signal import resample_poly
+
+from nsds_lab_to_nwb.components.neural_data.neural_data_originator import NeuralDataOriginator
+from nsds_lab_to_nwb.components.neural_data.resample_iterator import ResampleIterator
+from nsds_lab_to_nwb.tools.stream_iterator import StreamIterator
+
+
+def test_keep_native_dtype():
+    rate = 3051.7578125
+    t = np.arange(int(rate)) / rate
+    data = np.round(1000 * np.sin(2 * np.pi * 10 * t)[:, np.newaxis] * [1, 2]).astype('int16')
+
+    originator = NeuralDataOriginator(None, {}, keep_native_dtype=True)
+    originator.hardware_rate = rate
+    resampled = originator.resample(data)
+    assert resampled.dtype == np.float32
+    assert originator.resample_rate == 3000
+
+    native = originator._to_dtype(resampled, data.dtype)
+    assert native.dtype == np.int16
+    np.testing.assert_array_equal(native, np.rint(resampled))
+
+    dev_conf = {'conversion': 1e-6}
+    assert originator._get_resolution(dev_conf, native) == 1e-6
+    assert originator._get_resolution(dev_conf, resampled) == 1.
+
+
+@pytest.mark.parametrize('buffer_size', [1, 1000, 2**20])
+def test_resample_iterator(buffer_size):
+    rate = 3051.7578125
+    data = np.random.default_rng(0).standard_normal((5000, 3)).astype('float32')
+
+    originator = NeuralDataOriginator(None, {})
+    originator.hardware_rate = rate
+    resampled = originator.resample(StreamIterator(data, buffer_size=buffer_size))
+    assert isinstance(resampled, ResampleIterator)
+    assert (resampled.up, resampled.down) == (3072, 3125)
+    assert originator.resample_rate == 3000
+
+    # chunk by chunk equals resampling the whole recording at once
+    expected = resample_poly(data.astype('float64'), 3072, 3125, axis=0)
+    assert resampled.maxshape == expected.shape
+    out = np.full(resampled.maxshape, np.nan, dtype='float32')
+    for chunk in resampled:
+        assert chunk.data.dtype == np.float32
+        out[chunk.selection] = chunk.data
+    np.testing.assert_allclose(out, expected, atol=1e-5)
+
+
+def test_resample_iterator_native_dtype():
+    rate = 3051.7578125
+    t = np.arange(int(rate)) / rate
+    data = np.round(1000 * np.sin(2 * np.pi * 10 * t)[:, np.newaxis] * [1, 2]).astype('int16')
+
+    resampled = ResampleIterator(StreamIterator(data, buffer_size=512), 3000, rate, dtype='int16')
+    assert resampled.dtype == np.int16
+    chunks = list(resampled)
+    assert all(chunk.data.dtype == np.int16 for chunk in chunks)
+    expected = np.rint(resample_poly(data.astype('float64'), 3072, 3125, axis=0))
+    np.testing.assert_allclose(np.concatenate([chunk.data for chunk in chunks]), expected, atol=1)
+
+
+def make_nwb_content(num_electrodes):
+    '''Create an NWBFile with an ECoG electrode group, and a region of all its electrodes.
+    '''
+    from datetime import datetime, timezone
+    from pynwb import NWBFile
+
+    nwb_content = NWBFile(session_description='test', identifier='test',
+                          session_start_time=datetime(2020, 1, 1, tzinfo=timezone.utc))
+    device = nwb_content.create_device(name='ECoG')
+    group = nwb_content.create_electrode_group(name='ECoG', description='ECoG', location='brain', device=device)
+    for _ in range(num_electrodes):
+        nwb_content.add_electrode(location='brain', group=group)
+    region = nwb_content.create_electrode_table_region(region=list(range(num_electrodes)), description='ECoG')
+    return nwb_content, region
+
+
+def test_write_resampled_chunks(tmp_path):
+    from pynwb import NWBHDF5IO
+    from pynwb.ecephys import ElectricalSeries
+
+    rate = 3051.7578125
+    nwb_content, region = make_nwb_content(2)
+    # big-endian source, as streamed from HTK files
+    data = np.random.default_rng(0).standard_normal((5000, 2)).astype('>f4')
+    resampled = ResampleIterator(StreamIterator(data, buffer_size=700), 3000, rate)
+    nwb_content.add_acquisition(ElectricalSeries(name='ECoG', data=resampled, electrodes=region, rate=3000.))
+
+    with NWBHDF5IO(str(tmp_path / 'test.nwb'), 'w') as io:
+        io.write(nwb_content)
+    with NWBHDF5IO(str(tmp_path / 'test.nwb'), 'r') as io:
+        written = io.read().acquisition['ECoG'].data[:]
+    assert written.dtype == np.float32
+    np.testing.assert_allclose(written, resample_poly(data.astype('float64'), 3072, 3125, axis=0), atol=1e-5)
+
+
+def test_make_decomposition_series(tmp_path):
+    from pynwb import NWBHDF5IO
+
+    nwb_content, region = make_nwb_content(4)
+
+    data = np.random.default_rng(0).standard_normal((100, 4, 2)).astype('float32')
+    originator = NeuralDataOriginator(None, {'experiment_description': 'test'})
+    dev_conf = {'band_limits': [(70., 80.), (80., 90.), (90., 100.), (100., 110.)]}
+    originator.make_decomposition_series(nwb_content, 'ECoG', dev_conf, data,
+                                         {'sample_rate': 400., 'band_indices': [1, 3], 'bands': [80., 120.]},
+                                         region)
+    series = nwb_content.processing['ecephys']['ECoG']
+    assert series.rate == 400.
+    assert list(series.bands['band_name'][:]) == ['band1', 'band3']
+    np.testing.assert_array_equal(series.bands['band_mean'][:], [80., 120.])
+    # the limits of all bands are given, so the selected ones are picked by band index
+    np.testing.assert_array_equal(series.bands['band_limits'][:], [(80., 90.), (100., 110.)])
+
+    with NWBHDF5IO(str(tmp_path / 'test.nwb'), 'w') as io:
+        io.write(nwb_content)
+    with NWBHDF5IO(str(tmp_path / 'test.nwb'), 'r') as io:
+        np.testing.assert_array_equal(io.read().processing['ecephys']['ECoG'].data[:], data)
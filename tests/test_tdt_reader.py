@@ -0,0 +1,419 @@
+import os
+from datetime import datetime
+
+import numpy as np
+import pytest
+import tdt
+
+from nsds_lab_to_nwb.common.data_scanners import Dataset
+from nsds_lab_to_nwb.common.rec_manager import RecManager
+from nsds_lab_to_nwb.components.electrode.electrodes_originator import ElectrodesOriginator
+from nsds_lab_to_nwb.components.stimulus.mark_manager import MarkManager
+from nsds_lab_to_nwb.components.stimulus.trials_manager import TrialsManager
+from nsds_lab_to_nwb.tools.tdt.block_check import check_block
+from nsds_lab_to_nwb.tools.tdt.header_cache import get_cache_path, read_headers
+from nsds_lab_to_nwb.tools.tdt.sev_reader import SEV_HEADER_DTYPE, SEV_HEADER_LENGTH, SEVStream, find_sev_files
+from nsds_lab_to_nwb.tools.stream_iterator import StreamIterator
+from nsds_lab_to_nwb.tools.tdt.tdt_reader import TDTReader, probe_block
+
+
+# one TSQ record (event header), as written by the TDT hardware
+TSQ_DTYPE = np.dtype([('size', '<i4'), ('type', '<i4'), ('code', '<u4'),
+                      ('channel', '<u2'), ('sortcode', '<u2'), ('timestamp', '<f8'),
+                      ('offset', '<u8'), ('format', '<i4'), ('frequency', '<f4')])
+TSQ_FORMATS = {np.dtype('float32'): 0, np.dtype('int16'): 2}
+
+START_TIME = 1.6e9
+WAVE_RATE = 3051.7578125
+MARK_RATE = 1525.87890625
+MARK_ONSETS = [0.5, 1.5]
+
+
+def _store_code(name):
+    return np.frombuffer(name.encode(), dtype='<u4')[0]
+
+
+def write_tdt_block(block_path, streams, mark_onsets, start_time=START_TIME, npts=256):
+    '''Write a minimal TDT block (TSQ + TEV) with the given streams and mark epocs.
+
+    streams: dict of {store name: (sample rate, (channel, time) array)}
+    '''
+    os.makedirs(block_path, exist_ok=True)
+    block_name = os.path.basename(block_path)
+
+    records = [np.zeros((), TSQ_DTYPE)]
+    start = np.zeros((), TSQ_DTYPE)
+    start['code'] = tdt.EVMARK_STARTBLOCK
+    start['timestamp'] = start_time
+    records.append(start)
+
+    tev = bytearray()
+    for name, (rate, data) in streams.items():
+        num_channels, num_samples = data.shape
+        for k in range(num_samples // npts):
+            for ch in range(num_channels):
+                rec = np.zeros((), TSQ_DTYPE)
+                rec['size'] = 10 + npts * data.dtype.itemsize // 4
+                rec['type'] = tdt.EVTYPE_STREAM
+                rec['code'] = _store_code(name)
+                rec['channel'] = ch + 1
+                rec['timestamp'] = start_time + k * npts / rate
+                rec['offset'] = len(tev)
+                rec['format'] = TSQ_FORMATS[data.dtype]
+                rec['frequency'] = rate
+                tev += data[ch, k * npts:(k + 1) * npts].tobytes()
+                records.append(rec)
+
+    for onset in mark_onsets:
+        rec = np.zeros((), TSQ_DTYPE)
+        rec['size'] = 10
+        rec['type'] = tdt.EVTYPE_STRON
+        rec['code'] = _store_code('mark')
+        rec['timestamp'] = start_time + onset
+        rec['format'] = 4
+        records.append(rec)
+
+    stop = np.zeros((), TSQ_DTYPE)
+    stop['code'] = tdt.EVMARK_STOPBLOCK
+    stop['timestamp'] = start_time + 10.
+    records.append(stop)
+
+    np.array(records, dtype=TSQ_DTYPE).tofile(os.path.join(block_path, f'{block_name}.tsq'))
+    with open(os.path.join(block_path, f'{block_name}.tev'), 'wb') as f:
+        f.write(bytes(tev))
+
+
+def write_sev_files(block_path, name, data, num_hours=1):
+    '''Write a (channel, time) array as one SEV file per channel (and per hour),
+    at 3051.7578125 Hz (rate code 2, decimation 8).
+    '''
+    block_name = os.path.basename(block_path)
+    num_channels, num_samples = data.shape
+    hour_length = -(-num_samples // num_hours)
+    for ch in range(num_channels):
+        for hour in range(num_hours):
+            header = np.zeros((), SEV_HEADER_DTYPE)
+            header['file_type'] = b'SEV'
+            header['file_version'] = 3
+            header['event_name'] = name.encode()
+            header['channel_num'] = ch + 1
+            header['total_num_channels'] = num_channels
+            header['sample_width_bytes'] = data.dtype.itemsize
+            header['data_format'] = TSQ_FORMATS[data.dtype]
+            header['decimate'] = 8
+            header['rate'] = 2
+            suffix = f'-{hour}h' if hour > 0 else ''
+            sev_path = os.path.join(block_path, f'{block_name}_{name}_Ch{ch + 1}{suffix}.sev')
+            with open(sev_path, 'wb') as f:
+                f.write(header.tobytes().ljust(SEV_HEADER_LENGTH, b'\0'))
+                f.write(data[ch, hour * hour_length:(hour + 1) * hour_length].tobytes())
+
+
+@pytest.fixture
+def tdt_block(tmp_path):
+    rng = np.random.default_rng(0)
+    streams = {'Wave': (WAVE_RATE, rng.standard_normal((4, 2048)).astype('float32')),
+               'Poly': (WAVE_RATE, rng.standard_normal((8, 2048)).astype('float32')),
+               'mrk1': (MARK_RATE, rng.standard_normal((1, 1024)).astype('float32'))}
+    block_path = str(tmp_path / 'R01_B01')
+    write_tdt_block(block_path, streams, MARK_ONSETS)
+    return block_path, streams
+
+
+def test_read_full_block(tdt_block):
+    block_path, streams = tdt_block
+    reader = TDTReader(block_path)
+    assert sorted(reader.get_streams()) == ['Poly', 'Wave', 'mrk1']
+
+    data, meta = reader.get_data(stream='ECoG')
+    np.testing.assert_array_equal(data, streams['Wave'][1].T)
+    assert meta['num_channels'] == 4
+    assert meta['num_samples'] == 2048
+    np.testing.assert_allclose(reader.get_events(), MARK_ONSETS, atol=1e-4)
+
+
+def test_read_selected_stores(tdt_block):
+    block_path, streams = tdt_block
+    reader = TDTReader(block_path, stores=['ECoG', 'mrk1'])
+    assert reader.get_streams() == ['Wave', 'mrk1']
+    assert reader.block_name == 'R01_B01'
+
+    # nothing is decoded until requested
+    assert len(reader.tdt_obj['streams'].keys()) == 0
+    np.testing.assert_allclose(reader.get_events(), MARK_ONSETS, atol=1e-4)
+
+    data, meta = reader.get_data(stream='ECoG')
+    np.testing.assert_array_equal(data, streams['Wave'][1].T)
+    assert meta['sample_rate'] == WAVE_RATE
+    # the decoded store is handed over, not kept by the reader
+    assert list(reader.tdt_obj['streams'].keys()) == []
+
+    # stores that were not requested up front are never decoded
+    with pytest.raises(ValueError):
+        reader.get_data(stream='Poly')
+
+
+def test_probe_block(tdt_block):
+    block_path, streams = tdt_block
+    probe = probe_block(block_path)
+    assert probe['info']['blockname'] == 'R01_B01'
+    assert probe['info']['start_date'] == datetime.fromtimestamp(START_TIME)
+
+    assert sorted(probe['streams'].keys()) == ['Poly', 'Wave', 'mrk1']
+    for name, (rate, data) in streams.items():
+        stream_probe = probe['streams'][name]
+        assert stream_probe['sample_rate'] == rate
+        assert stream_probe['num_channels'] == data.shape[0]
+        assert stream_probe['channel_ids'] == list(range(1, data.shape[0] + 1))
+        assert stream_probe['num_samples'] == data.shape[1]
+        assert stream_probe['dtype'] == data.dtype
+    np.testing.assert_allclose(probe['epocs']['mark'], MARK_ONSETS, atol=1e-4)
+
+    # metadata of a store that has not been decoded comes from the headers
+    reader = TDTReader(block_path, stores=['ECoG', 'Poly'])
+    meta = reader.get_metadata('Poly')
+    assert meta['num_channels'] == 8
+    assert meta['num_samples'] == 2048
+    assert 'Poly' not in reader.tdt_obj['streams'].keys()
+
+
+@pytest.fixture
+def sev_block(tmp_path):
+    rng = np.random.default_rng(1)
+    wave = rng.standard_normal((4, 3000)).astype('float32')
+    mrk = rng.standard_normal((1, 1024)).astype('float32')
+    block_path = str(tmp_path / 'R01_B02')
+    write_tdt_block(block_path, {'mrk1': (MARK_RATE, mrk)}, MARK_ONSETS)
+    write_sev_files(block_path, 'Wave', wave, num_hours=2)
+    return block_path, wave
+
+
+def test_sev_stream(sev_block):
+    block_path, wave = sev_block
+    sev_files = find_sev_files(block_path)
+    assert list(sev_files.keys()) == ['Wave']
+
+    sev_stream = SEVStream(sev_files['Wave'])
+    assert sev_stream.shape == (3000, 4)
+    assert sev_stream.sample_rate == WAVE_RATE
+    # read across the boundary of the hourly files
+    np.testing.assert_array_equal(sev_stream[1400:1600], wave[:, 1400:1600].T)
+    np.testing.assert_array_equal(sev_stream[:, 2], wave[2])
+
+    sev_stream = SEVStream(sev_files['Wave'], channels=[2, 4])
+    np.testing.assert_array_equal(sev_stream[:], wave[[1, 3]].T)
+
+
+def test_read_memmap_sev(sev_block):
+    block_path, wave = sev_block
+    reader = TDTReader(block_path, stores=['ECoG', 'mrk1'], memmap_sev=True)
+    assert reader.get_streams() == ['Wave', 'mrk1']
+
+    data, meta = reader.get_data(stream='ECoG')
+    assert isinstance(data, StreamIterator)
+    assert meta['num_samples'] == 3000
+    assert meta['num_channels'] == 4
+
+    data.buffer_size = 1000
+    chunks = list(data)
+    assert len(chunks) == 3
+    for chunk in chunks:
+        np.testing.assert_array_equal(chunk.data, wave.T[chunk.selection])
+
+
+def test_stream_iterator_transposes_blocks(tdt_block):
+    block_path, streams = tdt_block
+    reader = TDTReader(block_path, stores=['Poly'])
+    data, _ = reader.get_data(stream='Poly')
+
+    data_iterator = StreamIterator(data, buffer_size=500)
+    assert data_iterator.maxshape == (2048, 8)
+    chunks = list(data_iterator)
+    assert [chunk.data.shape[0] for chunk in chunks] == [500, 500, 500, 500, 48]
+    for chunk in chunks:
+        assert chunk.data.flags['C_CONTIGUOUS']
+        np.testing.assert_array_equal(chunk.data, streams['Poly'][1].T[chunk.selection])
+
+
+def test_rec_manager_reads_in_blocks(tdt_block):
+    block_path, streams = tdt_block
+    dataset = Dataset('R01_B01', os.path.dirname(block_path), tdt_path=block_path)
+    metadata = {'device': {'ECoG': {}, 'Poly': {}}}
+    rec_manager = RecManager(dataset, metadata, buffer_size=1024)
+    assert rec_manager.get_required_stores() == ['ECoG', 'Poly', 'mrk1']
+
+    data, meta = rec_manager.read_neural_data('ECoG', metadata['device']['ECoG'])
+    assert isinstance(data, StreamIterator)
+    assert data.buffer_size == 1024
+    assert meta['num_channels'] == 4
+
+    mark_track, mark_rate = rec_manager.read_marks()
+    assert mark_rate == MARK_RATE
+    np.testing.assert_array_equal(mark_track, streams['mrk1'][1][0])
+
+
+def test_preview_trials(tdt_block):
+    block_path, streams = tdt_block
+    dataset = Dataset('R01_B01', os.path.dirname(block_path), tdt_path=block_path)
+    metadata = {'device': {'ECoG': {}}}
+    stim_configs = {'name': 'wn2', 'type': 'discrete', 'nsamples': 2, 'mark_offset': 0.1, 'first_mark': 0.5,
+                    'play_length': 2., 'duration': 0.1, 'baseline_start': 0.2, 'baseline_end': 0.4,
+                    'mark_threshold': 1.}
+
+    # the epoc onsets come from the headers alone
+    rec_manager = RecManager(dataset, metadata)
+    mark_events, rec_end_time = MarkManager(rec_manager, stim_configs, use_tdt_mark_events=True).preview_mark_events()
+    np.testing.assert_allclose(mark_events, MARK_ONSETS, atol=1e-4)
+    assert rec_end_time == 1024 / MARK_RATE
+    assert len(rec_manager.rec_reader.tdt_obj['streams'].keys()) == 0
+
+    # by default, the events are detected from the mark track, as when building
+    mark_manager = MarkManager(RecManager(dataset, metadata), stim_configs)
+    mark_events, rec_end_time = mark_manager.preview_mark_events()
+    np.testing.assert_array_equal(mark_events, mark_manager.get_mark_track()[2])
+    assert rec_end_time == 1024 / MARK_RATE
+
+    # previewing leaves the tokenizer of the trials manager as it is
+    trials_manager = TrialsManager('R01_B01', stim_configs)
+    trial_list = trials_manager.preview_trials(np.array(MARK_ONSETS), 2.)
+    assert [trial['sb'] for trial in trial_list] == ['b', 's', 'b', 's', 'b']
+    assert trials_manager.tokenizer.audio_start_time is None
+
+
+def read_chunks(data_iterator):
+    '''Concatenate the chunks of a StreamIterator.
+    '''
+    return np.concatenate([chunk.data for chunk in data_iterator])
+
+
+def test_read_mapped_channels(tdt_block, sev_block):
+    block_path, streams = tdt_block
+    dev_conf = {'ch_map': {ch: {'electrode_id': i} for i, ch in enumerate([7, 2, 5, 3])},
+                'bad_chs': [5]}
+    poly = streams['Poly'][1]
+
+    reader = TDTReader(block_path, stores=['Poly'])
+    data, meta = reader.get_data(stream='Poly', dev_conf=dev_conf)
+    # the channels are reordered block by block
+    assert isinstance(data, StreamIterator)
+    assert data.maxshape == (2048, 4)
+    np.testing.assert_array_equal(read_chunks(data), poly[[6, 1, 4, 2]].T)
+    assert meta['channel_ids'] == [7, 2, 5, 3]
+    assert meta['num_channels'] == 4
+
+    # only the mapped channels are decoded, in ascending order
+    np.testing.assert_array_equal(data.data, poly[[1, 2, 4, 6]].T)
+
+    reader = TDTReader(block_path, stores=['Poly'], drop_bad_chs=True)
+    data, meta = reader.get_data(stream='Poly', dev_conf=dev_conf)
+    np.testing.assert_array_equal(read_chunks(data), poly[[6, 1, 2]].T)
+    assert meta['channel_ids'] == [7, 2, 3]
+
+    block_path, wave = sev_block
+    reader = TDTReader(block_path, stores=['ECoG'], memmap_sev=True, drop_bad_chs=True)
+    dev_conf = {'ch_map': {ch: {} for ch in [4, 1, 2]}, 'bad_chs': [2]}
+    data, meta = reader.get_data(stream='ECoG', dev_conf=dev_conf)
+    assert meta['channel_ids'] == [4, 1]
+    np.testing.assert_array_equal(data.data[:], wave[[3, 0]].T)
+
+
+def test_electrodes_match_read_channels(tdt_block):
+    from pynwb import NWBFile
+
+    block_path, streams = tdt_block
+    dataset = Dataset('R01_B01', os.path.dirname(block_path), tdt_path=block_path)
+    # channel 9 is not in the store, channel 2 is bad
+    ch_map = {ch: {'electrode_id': i, 'x': 0., 'y': 0., 'z': 0.} for i, ch in enumerate([3, 9, 1, 2])}
+    dev_conf = {'ch_map': ch_map, 'bad_chs': [2], 'manufacturer': 'TDT', 'location': 'brain', 'imp': np.nan,
+                'filtering': 'none', 'descriptions': {'device_description': 'ECoG',
+                                                      'electrode_group_description': 'ECoG'}}
+    metadata = {'device': {'ECoG': dev_conf}}
+    rec_manager = RecManager(dataset, metadata, drop_bad_chs=True)
+    channels = {'ECoG': rec_manager.get_channels('ECoG', dev_conf)}
+    assert channels == {'ECoG': [3, 1]}
+
+    nwb_content = NWBFile(session_description='test', identifier='test', session_start_time=datetime.now())
+    region = ElectrodesOriginator(metadata, drop_bad_chs=True).make(nwb_content, channels=channels)['ECoG']
+    data, meta = rec_manager.read_neural_data('ECoG', dev_conf)
+    assert list(region.data) == [ch_map[ch]['electrode_id'] for ch in meta['channel_ids']] == [0, 2]
+    np.testing.assert_array_equal(read_chunks(data), streams['Wave'][1][[2, 0]].T)
+
+
+def test_rec_manager_decodes_in_parallel(tdt_block):
+    block_path, streams = tdt_block
+    dataset = Dataset('R01_B01', os.path.dirname(block_path), tdt_path=block_path)
+    metadata = {'device': {'ECoG': {'ch_map': {2: {}, 1: {}}}, 'Poly': {}, 'Missing': {}}}
+    rec_manager = RecManager(dataset, metadata, num_workers=2)
+    # nothing is decoded before the first read
+    np.testing.assert_allclose(rec_manager.read_mark_events(), MARK_ONSETS, atol=1e-4)
+    assert len(rec_manager.rec_reader.tdt_obj['streams'].keys()) == 0
+
+    data, meta = rec_manager.read_neural_data('ECoG', metadata['device']['ECoG'])
+    np.testing.assert_array_equal(read_chunks(data), streams['Wave'][1][[1, 0]].T)
+    assert sorted(rec_manager.futures.keys()) == ['Missing', 'Poly', 'mrk1']
+    data, meta = rec_manager.read_neural_data('Poly', metadata['device']['Poly'])
+    np.testing.assert_array_equal(data.data, streams['Poly'][1].T)
+    mark_track, _ = rec_manager.read_marks()
+    np.testing.assert_array_equal(mark_track, streams['mrk1'][1][0])
+
+    # errors from decoding are raised when the store is read
+    with pytest.raises(ValueError):
+        rec_manager.read_neural_data('Missing', metadata['device']['Missing'])
+
+
+def test_header_cache(tdt_block, tmp_path, monkeypatch):
+    block_path, streams = tdt_block
+    cache_dir = str(tmp_path / 'cache')
+    header = read_headers(block_path, cache_dir=cache_dir)
+    cache_path = get_cache_path(block_path, cache_dir)
+    assert os.path.exists(cache_path)
+
+    def no_tsq_parsing(*args, **kwargs):
+        raise AssertionError('TSQ file parsed again')
+    # reading the block again uses the cached headers
+    with monkeypatch.context() as m:
+        m.setattr(tdt, 'read_block', no_tsq_parsing)
+        cached = read_headers(block_path, cache_dir=cache_dir)
+    assert cached['tev_path'] == header['tev_path']
+    assert sorted(cached['stores'].keys()) == sorted(header['stores'].keys())
+    for name, store in header['stores'].items():
+        for key, value in store.items():
+            np.testing.assert_array_equal(cached['stores'][name][key], value)
+            assert type(cached['stores'][name][key]) is type(value)
+
+    reader = TDTReader(block_path, stores=['ECoG', 'mrk1'], cache_dir=cache_dir)
+    data, _ = reader.get_data(stream='ECoG')
+    np.testing.assert_array_equal(data, streams['Wave'][1].T)
+    np.testing.assert_allclose(reader.get_events(), MARK_ONSETS, atol=1e-4)
+
+    # a changed TSQ file is parsed again
+    tsq_path = os.path.join(block_path, 'R01_B01.tsq')
+    os.utime(tsq_path, ns=(0, 0))
+    assert get_cache_path(block_path, cache_dir) != cache_path
+
+
+def test_check_block(tdt_block):
+    block_path, streams = tdt_block
+    report = check_block(block_path, stores=['ECoG', 'Poly', 'mrk1'])
+    assert report == {'ok': True, 'issues': []}
+
+    report = check_block(block_path, stores=['ECoG', 'Missing'])
+    assert not report['ok']
+    assert [(issue['kind'], issue['store']) for issue in report['issues']] == [('missing_store', 'Missing')]
+
+    # cut off the last events of the last store in the TEV file
+    tev_path = os.path.join(block_path, 'R01_B01.tev')
+    os.truncate(tev_path, os.path.getsize(tev_path) - 1500)
+    report = check_block(block_path)
+    assert not report['ok']
+    [issue] = report['issues']
+    assert issue['kind'] == 'truncated_store'
+    assert issue['store'] == 'mrk1'
+    assert issue['num_truncated_events'] == 2
+
+    # a truncated store that is not converted is reported, but does not fail the block
+    report = check_block(block_path, stores=['ECoG', 'Poly'])
+    assert report['ok']
+    [issue] = report['issues']
+    assert (issue['kind'], issue['store'], issue['fatal']) == ('truncated_store', 'mrk1', False)
+    assert not check_block(block_path, stores=['ECoG', 'mrk1'])['ok']